@@ -1,51 +1,151 @@
 import docker
+import hashlib
 import json
 import os
 import os.path
+import re
+import signal
+import sys
+import threading
 import time
 import urllib
-import urllib2
 import uuid
+import gevent
+import gevent.event
 import yaml
-from docker_compose import get_project, ps_
-from flask import Flask, jsonify, request, abort
+from backends import BACKEND_DOCKER, load_backend
+from container_state import ContainerStateCache
+from deadlines import DeadlineScheduler
+from docker_events import EventWatcher
+from docker_compose import docker_call_latency
+from environments import Environment, EnvironmentRegistry, STATUS_IDLE, STATUS_PROVISIONING, STATUS_CLAIMED, \
+    STATUS_RUNNING, STATUS_UPDATING, STATUSES, STATUS_NAMES
+from flask import Flask, Response, jsonify, request, abort, stream_with_context
 from gevent import pywsgi
+from metrics import Counter, Gauge, Histogram, CONTENT_TYPE, render as render_metrics, timed
+from minienv_config import MinienvConfig, TabCache, get_tabs
+from placement import PlacementScheduler, parse_nodes
+from prewarm import ImageDemand, get_compose_images, get_coverage
+from progress import ProgressHub
+from repo_files import RepoFileCache
+from state_store import StateStore
+from templates import ComposeTemplate
 from threading import Timer
+from workers import Job, WorkerPool
 
 # global vars
 app = Flask(__name__)
-docker_client = docker.from_env()
+# MINIENV_BACKEND=fake runs against an in-memory docker for load testing
+backend = load_backend(os.environ.get('MINIENV_BACKEND', BACKEND_DOCKER), os.environ.get('MINIENV_FAKE_LATENCIES', ''),
+                       os.environ.get('MINIENV_FAKE_REPO_DIR') or None)
+docker_client = backend.client
+get_project = backend.get_project
+ps_ = backend.ps_
+invalidate_project = backend.invalidate_project
 allow_origin = os.environ.get('MINIENV_ALLOW_ORIGIN')
 node_host_name = os.environ.get('MINIENV_NODE_HOST_NAME')
 provision_volume_driver = os.environ.get('MINIENV_PROVISION_VOLUME_DRIVER', '')
 provision_volume_driver_opts = os.environ.get('MINIENV_PROVISION_VOLUME_DRIVER_OPTS', '')
 provision_images = os.environ.get('MINIENV_PROVISION_IMAGES', '')
 repo_whitelist = os.environ.get('MINIENV_REPO_WHITELIST', '')
-environments = []
+provision_parallelism = int(os.environ.get('MINIENV_PROVISION_PARALLELISM', 4))
+provision_timeout_seconds = int(os.environ.get('MINIENV_PROVISION_TIMEOUT_SECONDS', 600))
+provision_pool = WorkerPool('provisioner', provision_parallelism)
+provision_retries = int(os.environ.get('MINIENV_PROVISION_RETRIES', 2))
+provision_lock = threading.Lock()
+pool_min_size = int(os.environ.get('MINIENV_PROVISION_COUNT', 1))
+pool_max_size = int(os.environ.get('MINIENV_POOL_MAX_SIZE', pool_min_size))
+pool_min_idle = int(os.environ.get('MINIENV_POOL_MIN_IDLE', 0))
+pool_cooldown_seconds = int(os.environ.get('MINIENV_POOL_COOLDOWN_SECONDS', 300))
+pool_last_growth = 0
+node_capacity = int(os.environ.get('MINIENV_NODE_CAPACITY', max(pool_max_size, pool_min_size)))
+placement = PlacementScheduler(parse_nodes(os.environ.get('MINIENV_NODES', ''), node_host_name, node_capacity))
+affinity_claims = Counter('minienv_affinity_claims_total', 'Claims with a repo hint, by whether a warm environment matched')
+affinity_ups = Counter('minienv_affinity_ups_total', 'Up requests, by whether an existing deployment was reused')
+request_latency = Histogram('minienv_request_seconds', 'Time spent handling API requests, by route')
+check_duration = Gauge('minienv_check_environments_seconds', 'Duration of the last check_environments pass')
+environment_count = Gauge('minienv_environments', 'Environments by status',
+                          lambda: [({'status': STATUS_NAMES[status]}, environments.count(status))
+                                   for status in STATUSES])
+node_environments = Gauge('minienv_node_environments', 'Environments placed on each node',
+                          lambda: [({'node': node.name}, len(node.env_ids)) for node in placement.nodes.values()])
+claim_queue_length = Gauge('minienv_claim_queue_length', 'Claims waiting for an environment',
+                           lambda: [({}, environments.queue_length())])
+deploy_workers = int(os.environ.get('MINIENV_DEPLOY_WORKERS', 4))
+deploy_pool = WorkerPool('deployer', deploy_workers)
+repo_cache_ttl_seconds = int(os.environ.get('MINIENV_REPO_CACHE_TTL_SECONDS', 300))
+repo_cache_negative_ttl_seconds = int(os.environ.get('MINIENV_REPO_CACHE_NEGATIVE_TTL_SECONDS', 60))
+repo_cache_max_entries = int(os.environ.get('MINIENV_REPO_CACHE_MAX_ENTRIES', 256))
+repo_files = backend.repo_files or RepoFileCache(repo_cache_ttl_seconds, repo_cache_negative_ttl_seconds,
+                                                 repo_cache_max_entries)
+up_tabs = TabCache(repo_cache_max_entries)
+container_state_max_age_seconds = float(os.environ.get('MINIENV_CONTAINER_STATE_MAX_AGE_SECONDS', 5))
+container_states = ContainerStateCache(docker_client.api, container_state_max_age_seconds)
+prewarm_image_count = int(os.environ.get('MINIENV_PREWARM_IMAGES', 5))
+prewarm_parallelism = int(os.environ.get('MINIENV_PREWARM_PARALLELISM', 1))
+prewarm_interval_seconds = int(os.environ.get('MINIENV_PREWARM_INTERVAL_SECONDS', 60))
+prewarm_max_new_images = int(os.environ.get('MINIENV_PREWARM_MAX_NEW_IMAGES', 3))
+prewarm_reserve = int(os.environ.get('MINIENV_PREWARM_RESERVE', 1))
+prewarm_pool = WorkerPool('prewarm', prewarm_parallelism)
+prewarm_jobs = []
+last_prewarm = 0
+image_demand = ImageDemand()
+prewarm_runs = Counter('minienv_prewarm_runs_total', 'Pre-warm provisioner runs, by outcome')
+image_coverage = Gauge('minienv_image_coverage', 'Share of the most requested images loaded in each environment',
+                       lambda: [({'env': environment.id}, get_coverage(environment.images,
+                                                                       image_demand.top(prewarm_image_count)))
+                                for environment in environments])
+teardown_workers = int(os.environ.get('MINIENV_TEARDOWN_WORKERS', 2))
+teardown_retries = int(os.environ.get('MINIENV_TEARDOWN_RETRIES', 3))
+teardown_on_shutdown = os.environ.get('MINIENV_TEARDOWN_ON_SHUTDOWN', 'false').lower() == 'true'
+teardown_pool = WorkerPool('teardown', teardown_workers)
+teardown_jobs = {}
+teardown_jobs_lock = threading.Lock()
+progress_buffer_size = int(os.environ.get('MINIENV_PROGRESS_BUFFER_SIZE', 64))
+progress_keep_alive_seconds = int(os.environ.get('MINIENV_PROGRESS_KEEP_ALIVE_SECONDS', 15))
+progress = ProgressHub(progress_buffer_size)
+# claim token each environment's progress was last published under
+progress_claims = {}
+health_mode = os.environ.get('MINIENV_HEALTH_MODE', 'poll')
+reconcile_seconds = int(os.environ.get('MINIENV_RECONCILE_SECONDS', 300))
+last_reconcile = 0
+# ./state is a volume in the image; mount a named volume there (docker run
+# -v minienv-state:/app/state) so claims survive the container being replaced
+state_file = os.environ.get('MINIENV_STATE_FILE', './state/minienv-state.db')
+state_store = StateStore(state_file) if state_file else None
+instance_id = uuid.uuid4().hex[:8]
 
 MINIENV_VERSION = "latest"
 
-STATUS_IDLE = 0
-STATUS_PROVISIONING = 1
-STATUS_CLAIMED = 2
-STATUS_RUNNING = 3
-STATUS_UPDATING = 4
-
 CHECK_ENV_TIMER_SECONDS = 15
-DELETE_ENV_NO_ACIVITY_SECONDS = 60
-EXPIRE_CLAIM_NO_ACIVITY_SECONDS = 30
-
-VAR_MINIENV_VERSION = "$minienvVersion"
-VAR_INTERNAL_LOG_PORT = "$internalLogPort"
-VAR_INTERNAL_EDITOR_PORT = "$internalEditorPort"
-VAR_INTERNAL_PROXY_PORT = "$internalProxyPort"
-VAR_EXTERNAL_LOG_PORT = "$externalLogPort"
-VAR_EXTERNAL_EDITOR_PORT = "$externalEditorPort"
-VAR_EXTERNAL_PROXY_PORT = "$externalProxyPort"
-VAR_GIT_REPO = "$gitRepo"
-VAR_ALLOW_ORIGIN = "$allowOrigin"
-VAR_VOLUME_NAME = "$volumeName"
-VAR_PROVISON_IMAGES = "$provisionImages"
+DELETE_ENV_NO_ACIVITY_SECONDS = int(os.environ.get('MINIENV_DELETE_ENV_NO_ACTIVITY_SECONDS', 60))
+EXPIRE_CLAIM_NO_ACIVITY_SECONDS = int(os.environ.get('MINIENV_EXPIRE_CLAIM_NO_ACTIVITY_SECONDS', 30))
+EXPIRE_CLAIM_TICKET_NO_ACIVITY_SECONDS = int(os.environ.get('MINIENV_EXPIRE_CLAIM_TICKET_NO_ACTIVITY_SECONDS', 30))
+CLAIM_TICKET_COOKIE = 'minienv_claim_ticket'
+
+environments = EnvironmentRegistry(EXPIRE_CLAIM_TICKET_NO_ACIVITY_SECONDS)
+
+HEALTH_MODE_POLL = 'poll'
+HEALTH_MODE_EVENTS = 'events'
+
+# compose strips the dashes from our project names when labelling containers
+PROJECT_LABEL_PATTERN = re.compile(r'^minienvenv(\d+)(provision)?$')
+
+VAR_MINIENV_VERSION = "minienvVersion"
+VAR_LOG_PORT = "logPort"
+VAR_EDITOR_PORT = "editorPort"
+VAR_PROXY_PORT = "proxyPort"
+VAR_INTERNAL_LOG_PORT = "internalLogPort"
+VAR_INTERNAL_EDITOR_PORT = "internalEditorPort"
+VAR_INTERNAL_PROXY_PORT = "internalProxyPort"
+VAR_EXTERNAL_LOG_PORT = "externalLogPort"
+VAR_EXTERNAL_EDITOR_PORT = "externalEditorPort"
+VAR_EXTERNAL_PROXY_PORT = "externalProxyPort"
+VAR_GIT_REPO = "gitRepo"
+VAR_ALLOW_ORIGIN = "allowOrigin"
+VAR_VOLUME_NAME = "volumeName"
+VAR_PROVISON_IMAGES = "provisionImages"
+VAR_NODE_NAME = "nodeName"
 
 
 DEFAULT_INTERNAL_LOG_PORT = "30081"
@@ -56,6 +156,21 @@ EXTERNAL_EDITOR_PORT_START = 40001
 EXTERNAL_PROXY_PORT_START = 40002
 EXTERNAL_PORT_INCREMENT = 10
 
+env_template = ComposeTemplate('./docker-compose-env.yml.template')
+provision_template = ComposeTemplate('./docker-compose-provision.yml.template')
+
+
+class DeployError(Exception):
+    pass
+
+
+class ProvisionError(Exception):
+    pass
+
+
+class TeardownError(Exception):
+    pass
+
 
 @app.after_request
 def add_header(r):
@@ -66,12 +181,18 @@ def add_header(r):
     return r
 
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype=CONTENT_TYPE)
+
+
 @app.route('/api/whitelist', methods=['GET'])
 def whitelist():
     return jsonify({'repos': []})
 
 
 @app.route('/api/claim', methods=['POST'])
+@timed(request_latency, route='claim')
 def claim():
     # if body is None throw error
     claim_request = request.get_json()
@@ -79,26 +200,50 @@ def claim():
         abort(400)
         return
     claim_response = {}
+    # a client that claims again while queued (with the ticket in the body, or
+    # in the cookie set for clients that only know how to retry) keeps its
+    # place instead of joining the back of the queue
+    ticket = claim_request.get('claimTicket') or request.cookies.get(CLAIM_TICKET_COOKIE)
+    waiter = environments.find_ticket(ticket, time.time()) if ticket else None
+    if waiter is not None and waiter.environment is not None and \
+            environments.find_by_claim_token(waiter.claim_token) is not waiter.environment:
+        # granted, but that claim has since ended
+        waiter = None
+    if waiter is not None and waiter.environment is not None:
+        print('Claim ticket {} granted environment {}.'.format(waiter.ticket, waiter.environment.id))
+        claim_response['claimGranted'] = True
+        claim_response['claimToken'] = waiter.claim_token
+        return jsonify(claim_response)
     environment = None
-    for element in environments:
-        if element['status'] == STATUS_IDLE:
-            environment = element
-            break
+    if waiter is None:
+        # optional hint: the repo the client is about to bring up
+        repo = claim_request.get('repo')
+        environment = environments.claim(str(uuid.uuid4()), time.time(), repo)
+        if environment is not None and repo:
+            affinity_claims.inc(result='hit' if environment.repo == repo else 'miss')
     if environment is None:
-        print('Claim failed; no environments available.')
+        # queue the claim; the next environment to become idle is handed to
+        # the oldest ticket and the client picks it up with /api/ping
+        if waiter is None:
+            waiter = environments.enqueue(str(uuid.uuid4()), str(uuid.uuid4()), time.time())
+            print('Claim queued; no environments available.')
         claim_response['claimGranted'] = False
         claim_response['message'] = 'No environments available'
-    else:
-        print('Claimed environment {}.'.format(environment['id']))
-        claim_response['claimGranted'] = True
-        claim_response['claimToken'] = str(uuid.uuid4())
-        environment['claimToken'] = claim_response['claimToken']
-        environment['status'] = STATUS_CLAIMED
-        environment['lastActivity'] = time.time()
+        claim_response['claimTicket'] = waiter.ticket
+        claim_response['queuePosition'] = environments.queue_position(waiter)
+        claim_response['estimatedWaitSeconds'] = environments.estimated_wait(waiter)
+        response = jsonify(claim_response)
+        response.set_cookie(CLAIM_TICKET_COOKIE, waiter.ticket, max_age=EXPIRE_CLAIM_TICKET_NO_ACIVITY_SECONDS,
+                            httponly=True)
+        return response
+    print('Claimed environment {}.'.format(environment.id))
+    claim_response['claimGranted'] = True
+    claim_response['claimToken'] = environment.claim_token
     return jsonify(claim_response)
 
 
 @app.route('/api/ping', methods=['POST'])
+@timed(request_latency, route='ping')
 def ping():
     # if body is None throw error
     ping_request = request.get_json()
@@ -106,43 +251,94 @@ def ping():
         abort(400)
         return
     ping_response = {}
-    environment = None
-    for element in environments:
-        if element['claimToken'] == ping_request['claimToken']:
-            environment = element
-            break
+    claim_token = ping_request.get('claimToken')
+    if not claim_token and ping_request.get('claimTicket'):
+        waiter = environments.find_ticket(ping_request['claimTicket'], time.time())
+        if waiter is None or waiter.environment is None:
+            ping_response['claimGranted'] = False
+            ping_response['up'] = False
+            if waiter is not None:
+                ping_response['claimTicket'] = waiter.ticket
+                ping_response['queuePosition'] = environments.queue_position(waiter)
+                ping_response['estimatedWaitSeconds'] = environments.estimated_wait(waiter)
+            return jsonify(ping_response)
+        print('Claim ticket {} granted environment {}.'.format(waiter.ticket, waiter.environment.id))
+        claim_token = waiter.claim_token
+        ping_response['claimToken'] = claim_token
+    ping_response.update(get_ping_response(claim_token, ping_request.get('getEnvDetails'),
+                                           ping_request.get('envVersion')))
+    return jsonify(ping_response)
+
+
+@app.route('/api/ping/batch', methods=['POST'])
+@timed(request_latency, route='ping_batch')
+def ping_batch():
+    # one request for many sessions; container state for the whole batch
+    # comes from a single bulk listing (container_states)
+    batch_request = request.get_json()
+    if batch_request is None or not isinstance(batch_request.get('pings'), list):
+        abort(400)
+        return
+    get_env_details = batch_request.get('getEnvDetails')
+    pings = []
+    for ping_request in batch_request['pings']:
+        claim_token = ping_request.get('claimToken')
+        ping_response = get_ping_response(claim_token, ping_request.get('getEnvDetails', get_env_details),
+                                          ping_request.get('envVersion'))
+        ping_response['claimToken'] = claim_token
+        pings.append(ping_response)
+    return jsonify({'pings': pings})
+
+
+def get_ping_response(claim_token, get_env_details, env_version=None):
+    # env_version is the envVersion of the details the client already has;
+    # details are only sent again when they changed
+    ping_response = {}
+    environment = environments.touch(claim_token, time.time())
+    if environment is not None:
+        schedule_expiry(environment)
     if environment is None:
         ping_response['claimGranted'] = False
         ping_response['up'] = False
     else:
-        environment['lastActivity'] = time.time()
         ping_response['claimGranted'] = True
-        ping_response['up'] = environment['status'] == STATUS_RUNNING
-        ping_response['repo'] = environment['repo']
-        if ping_response['up'] and 'getEnvDetails' in ping_request.keys() and ping_request['getEnvDetails']:
+        ping_response['up'] = environment.status == STATUS_RUNNING
+        ping_response['repo'] = environment.repo
+        if environment.up_job is not None:
+            ping_response['upJob'] = get_up_job_response(environment.up_job)
+        if ping_response['up'] and get_env_details:
             # make sure to check if it is really running
-            exists = is_env_deployed(environment['id'])
+            exists = is_env_deployed(environment.id)
             ping_response['up'] = exists
             if exists:
-                ping_response['envDetails'] = environment['details']
+                version = get_env_version(environment)
+                ping_response['envVersion'] = version
+                if version == env_version:
+                    ping_response['envDetailsUnchanged'] = True
+                else:
+                    ping_response['envDetails'] = environment.details
             else:
-                environment['status'] = STATUS_CLAIMED
-                environment['repo'] = None
-                environment['details'] = None
-    return jsonify(ping_response)
+                environments.transition(environment, STATUS_RUNNING, STATUS_CLAIMED, claim_token,
+                                        repo=None, details=None, warm_details=None)
+    return ping_response
+
+
+def get_env_version(environment):
+    # versions restart with the process, so they are qualified by the instance
+    return '{}-{}'.format(instance_id, environment.version)
 
 
 @app.route('/api/up', methods=['POST'])
+@timed(request_latency, route='up')
 def up():
     up_request = request.get_json()
     if up_request is None:
         abort(400)
         return
-    environment = None
-    for element in environments:
-        if element['claimToken'] == up_request['claimToken']:
-            environment = element
-            break
+    # an up request is activity on the claim like a ping
+    environment = environments.touch(up_request['claimToken'], time.time())
+    if environment is not None:
+        schedule_expiry(environment)
     if environment is None:
         print('Up request failed; claim no longer valid.')
         abort(401)
@@ -150,33 +346,141 @@ def up():
     else:
         up_response = None
         # download minienv.json file
-        print('Checking if deployment exists for env {}...'.format(environment['id']))
-        if is_env_deployed(environment['id']):
-            print('Env deployed for claim {}.'.format(environment['id']))
-            if environment['status'] == STATUS_RUNNING and up_request['repo'] == environment['repo']:
+        print('Checking if deployment exists for env {}...'.format(environment.id))
+        if is_env_deployed(environment.id):
+            print('Env deployed for claim {}.'.format(environment.id))
+            if environment.status == STATUS_RUNNING and up_request['repo'] == environment.repo:
                 print('Returning existing environment details...')
-                up_response = environment['details']
+                up_response = dict(environment.details, status=STATUS_RUNNING)
+            elif up_request['repo'] == environment.repo and environment.warm_details is not None:
+                # the repo is still deployed from the environment's previous claim
+                if environments.transition(environment, STATUS_CLAIMED, STATUS_RUNNING, up_request['claimToken'],
+                                           details=environment.warm_details, last_activity=time.time()):
+                    print('Reusing warm deployment for env {}...'.format(environment.id))
+                    affinity_ups.inc(result='reused')
+                    up_response = dict(environment.details, status=STATUS_RUNNING)
         if up_response is None:
             print('Creating new deployment...')
             # change status to updating, so the scheduler doesn't think it has stopped when the old repo is shutdown
-            environment['status'] = STATUS_UPDATING
-            details = deploy_env(up_request, environment)
+            job = Job(run_up_job, (up_request, environment), {})
+            if environments.transition(environment, (STATUS_CLAIMED, STATUS_RUNNING), STATUS_UPDATING,
+                                       up_request['claimToken'], up_request=up_request, up_job=job):
+                deploy_pool.put(job)
+            elif environment.claim_token != up_request['claimToken']:
+                print('Up request failed; claim no longer valid.')
+                abort(401)
+                return
+            elif environment.status == STATUS_UPDATING and environment.up_request['repo'] == up_request['repo']:
+                print('Joining running deployment for env {}...'.format(environment.id))
+                job = environment.up_job
+            else:
+                print('Up request failed; environment {} is already updating.'.format(environment.id))
+                abort(409)
+                return
             up_response = {
                 'repo': up_request['repo'],
-                'deployToBluemix': False,
-                'logUrl': details['logUrl'],
-                'editorUrl': details['editorUrl'],
-                'tabs': details['tabs']
+                'status': STATUS_UPDATING,
+                'upJob': get_up_job_response(job)
             }
-            environment['status'] = STATUS_RUNNING
-            environment['repo'] = up_request['repo']
-            environment['details'] = up_response
         return jsonify(up_response)
 
 
-def deploy_provisioner(environment):
+@app.route('/api/progress', methods=['GET'])
+def progress_stream():
+    # server-sent events for the deployments of one claim; GET with the
+    # claim token in the query string so EventSource can be used
+    claim_token = request.args.get('claimToken')
+    environment = environments.find_by_claim_token(claim_token)
+    if environment is None:
+        abort(401)
+        return
+    # events are pushed from worker threads; an async watcher is the
+    # thread-safe way to wake this greenlet from one
+    wake = gevent.event.Event()
+    watcher = gevent.get_hub().loop.async()
+    watcher.start(wake.set)
+    subscription = progress.subscribe(claim_token, watcher.send)
+
+    def stream():
+        try:
+            yield 'retry: 2000\n\n'
+            while True:
+                # an open stream is activity on the claim like a ping
+                if environments.touch(claim_token, time.time()) is not environment:
+                    break
+                schedule_expiry(environment)
+                events = subscription.drain()
+                for event_id, name, data in events:
+                    yield format_event(event_id, name, data)
+                if len(events) == 0:
+                    yield ': keep-alive\n\n'
+                wake.wait(progress_keep_alive_seconds)
+                wake.clear()
+            yield format_event(0, 'end', {'claimGranted': False})
+        finally:
+            subscription.close()
+            watcher.stop()
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def format_event(event_id, name, data):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(event_id, name, json.dumps(data))
+
+
+def end_progress(environment):
+    # progress is keyed by claim, so a new claim on the environment (even one
+    # handed straight to a queued ticket) never sees the last one's events
+    previous = progress_claims.get(environment.id)
+    if previous == environment.claim_token:
+        return
+    if previous:
+        progress.forget(previous)
+    if environment.claim_token:
+        progress_claims[environment.id] = environment.claim_token
+    else:
+        progress_claims.pop(environment.id, None)
+
+
+def run_up_job(up_request, environment):
+    job = environment.up_job
+    try:
+        details = deploy_env(up_request, environment, job)
+    except:
+        environments.transition(environment, STATUS_UPDATING, STATUS_CLAIMED, up_request['claimToken'],
+                                repo=None, details=None, warm_details=None)
+        progress.publish(up_request['claimToken'], 'failed', {'jobId': job.id, 'error': str(sys.exc_info()[1])})
+        raise
+    up_response = {
+        'repo': up_request['repo'],
+        'deployToBluemix': False,
+        'logUrl': details['logUrl'],
+        'editorUrl': details['editorUrl'],
+        'tabs': details['tabs']
+    }
+    # the inactivity timeout starts when the environment is up, not at the
+    # last ping before a deployment that may have taken longer than it
+    if environments.transition(environment, STATUS_UPDATING, STATUS_RUNNING, up_request['claimToken'],
+                               repo=up_request['repo'], details=up_response, last_activity=time.time()):
+        progress.publish(up_request['claimToken'], 'up', {'jobId': job.id, 'envDetails': up_response})
+    return up_response
+
+
+def get_up_job_response(job):
+    up_job_response = {
+        'jobId': job.id,
+        'state': job.state,
+        'phase': job.phase
+    }
+    if job.error is not None:
+        up_job_response['error'] = str(job.error)
+    return up_job_response
+
+
+def deploy_provisioner(environment, images=None):
     # create volume if it doesn't exist
-    volume_name = get_volume_name(environment['id'])
+    volume_name = get_volume_name(environment.id)
     try:
         docker_client.volumes.get(volume_name)
     except docker.errors.NotFound:
@@ -195,32 +499,32 @@ def deploy_provisioner(environment):
             kwargs['driver_opts'] = driver_opts
         docker_client.volumes.create(volume_name, **kwargs)
     # check if environment already running
-    if is_provisioner_running(environment['id']):
-        print('Deleting existing provisioner {}...'.format(environment['id']))
-        delete_provisioner(environment['id'])
+    if is_provisioner_running(environment.id):
+        print('Deleting existing provisioner {}...'.format(environment.id))
+        job = teardown_provisioner(environment.id)
+        job.wait()
+        if job.error is not None:
+            raise job.error
     # run using docker-compose
-    project_name = get_provisioner_project_name(environment['id'])
-    src_file_name = './docker-compose-provision.yml.template'
+    project_name = get_provisioner_project_name(environment.id)
     dest_file_name = './docker-compose-{}.yml'.format(project_name)
-    src_file = open(src_file_name, 'r')
-    dest_file = open(dest_file_name, 'w')
-    for line in src_file:
-        line = line.replace(VAR_MINIENV_VERSION, MINIENV_VERSION)
-        line = line.replace(VAR_PROVISON_IMAGES, provision_images)
-        line = line.replace(VAR_VOLUME_NAME, volume_name)
-        dest_file.write(line)
-    src_file.close()
-    dest_file.close()
-    project = get_project('./', project_name, dest_file_name)
-    project.up(detached=True, strategy=2)  # strategy 2 = always re-create
+    config = provision_template.write(dest_file_name, {
+        VAR_MINIENV_VERSION: MINIENV_VERSION,
+        VAR_PROVISON_IMAGES: ','.join(images) if images is not None else provision_images,
+        VAR_VOLUME_NAME: volume_name,
+        VAR_NODE_NAME: environment.node
+    })
+    project = get_project('./', project_name, dest_file_name, config)
+    with docker_call_latency.time(call='project.up'):
+        project.up(detached=True, strategy=2)  # strategy 2 = always re-create
+    container_states.invalidate()
 
 
 def is_provisioner_running(env_id):
     project_name = get_provisioner_project_name(env_id)
     project_file_name = './docker-compose-{}.yml'.format(project_name)
     if os.path.isfile(project_file_name):
-        project = get_project('./', project_name, project_file_name)
-        ps = ps_(project)
+        ps = container_states.get(project_name)
         return is_project_starting(ps) or is_project_running(ps)
     else:
         return False
@@ -229,81 +533,101 @@ def is_provisioner_running(env_id):
 def delete_provisioner(env_id):
     project_name = get_provisioner_project_name(env_id)
     project_file_name = './docker-compose-{}.yml'.format(project_name)
+    if not os.path.isfile(project_file_name):
+        return
     project = get_project('./', project_name, project_file_name)
     ps = ps_(project)
     if is_project_running(ps):
-        project.down(1, False, remove_orphans=True)
+        with docker_call_latency.time(call='project.down'):
+            project.down(1, False, remove_orphans=True)
+        container_states.invalidate()
     os.remove(project_file_name)
+    invalidate_project(project_name)
     
     
-def deploy_env(up_request, environment):
-    print('Deploying environment {}...'.format(environment['id']))
+def deploy_env(up_request, environment, job=None):
+    print('Deploying environment {}...'.format(environment.id))
+    set_job_phase(job, 'fetching', up_request)
+    # download minienv.json and the docker-compose file (yml or yaml) concurrently
+    files = repo_files.get_many(up_request['repo'], ['minienv.json', 'docker-compose.yml', 'docker-compose.yaml'])
     minienv_dict = {}
-    minienv_json = None
-    try:
-        response = urllib2.urlopen('{}/raw/master/minienv.json'.format(up_request['repo']))
-        minienv_json = response.read()
-    except:
-        print('Error downloading minienv.json')
+    minienv_json = files['minienv.json']
     if minienv_json is not None and len(minienv_json) > 0:
         minienv_dict = json.loads(minienv_json)
-    # download docker-compose file (first try yml, then yaml)
-    docker_compose_yaml = None
-    try:
-        response = urllib2.urlopen('{}/raw/master/docker-compose.yml'.format(up_request['repo']))
-        docker_compose_yaml = response.read()
-    except:
-        print('Error downloading docker-compose.yml')
+    minienv_config = MinienvConfig(minienv_dict)
+    # prefer yml, then yaml
+    docker_compose_yaml = files['docker-compose.yml']
     if docker_compose_yaml is None or len(docker_compose_yaml) == 0:
-        try:
-            response = urllib2.urlopen('{}/raw/master/docker-compose.yaml'.format(up_request['repo']))
-            docker_compose_yaml = response.read()
-        except:
-            print('Error downloading docker-compose.yaml')
+        docker_compose_yaml = files['docker-compose.yaml']
     if docker_compose_yaml is None or len(docker_compose_yaml) == 0:
-        abort(400)
-        return
+        raise DeployError('No docker-compose file found in {}'.format(up_request['repo']))
     docker_compose_dict = yaml.safe_load(docker_compose_yaml)
+    content_digest = hashlib.sha1('{}\0{}'.format(minienv_json or '', docker_compose_yaml)).hexdigest()
+    image_demand.record(get_compose_images(docker_compose_dict))
+    # keep the existing deployment if it is still there and already runs this repo
+    deployed = is_env_deployed(environment.id)
+    reuse = deployed and environment.repo == up_request['repo']
     # check if environment already running
-    if is_env_deployed(environment['id']):
-        print('Deleting existing environment {}...'.format(environment['id']))
-        delete_env(environment['id'])
+    if deployed and not reuse:
+        print('Deleting existing environment {}...'.format(environment.id))
+        set_job_phase(job, 'deleting', up_request)
+        # the new deployment needs the old one's ports, so this one waits
+        teardown_job = teardown_env(environment.id)
+        teardown_job.wait()
+        if teardown_job.error is not None:
+            raise DeployError('Could not delete existing environment: {}'.format(teardown_job.error))
     # run using docker-compose
-    project_name = get_env_project_name(environment['id'])
-    volume_name = get_volume_name(environment['id'])
-    src_file_name = './docker-compose-env.yml.template'
+    project_name = get_env_project_name(environment.id)
+    volume_name = get_volume_name(environment.id)
     dest_file_name = './docker-compose-{}.yml'.format(project_name)
-    src_file = open(src_file_name, 'r')
-    dest_file = open(dest_file_name, 'w')
-    external_log_port = str(EXTERNAL_LOG_PORT_START+(environment['index']*EXTERNAL_PORT_INCREMENT))
-    external_editor_port = str(EXTERNAL_EDITOR_PORT_START+(environment['index']*EXTERNAL_PORT_INCREMENT))
-    external_proxy_port = str(EXTERNAL_PROXY_PORT_START+(environment['index']*EXTERNAL_PORT_INCREMENT))
-    for line in src_file:
-        line = line.replace(VAR_INTERNAL_LOG_PORT, DEFAULT_INTERNAL_LOG_PORT)
-        line = line.replace(VAR_INTERNAL_EDITOR_PORT, DEFAULT_INTERNAL_EDITOR_PORT)
-        line = line.replace(VAR_INTERNAL_PROXY_PORT, DEFAULT_INTERNAL_PROXY_PORT)
-        line = line.replace(VAR_EXTERNAL_LOG_PORT, external_log_port)
-        line = line.replace(VAR_EXTERNAL_EDITOR_PORT, external_editor_port)
-        line = line.replace(VAR_EXTERNAL_PROXY_PORT, external_proxy_port)
-        line = line.replace(VAR_GIT_REPO, up_request['repo'])
-        line = line.replace(VAR_ALLOW_ORIGIN, allow_origin)
-        line = line.replace(VAR_VOLUME_NAME, volume_name)
-        dest_file.write(line)
-    src_file.close()
-    dest_file.close()
-    project = get_project('./', project_name, dest_file_name)
-    print('Running docker-compose up for environment {}...'.format(environment['id']))
-    project.up(detached=True, strategy=2)  # strategy 2 = always re-create
+    # port blocks are per node, so environments on different nodes can share them
+    external_log_port = str(EXTERNAL_LOG_PORT_START+(environment.slot*EXTERNAL_PORT_INCREMENT))
+    external_editor_port = str(EXTERNAL_EDITOR_PORT_START+(environment.slot*EXTERNAL_PORT_INCREMENT))
+    external_proxy_port = str(EXTERNAL_PROXY_PORT_START+(environment.slot*EXTERNAL_PORT_INCREMENT))
+    config = env_template.write(dest_file_name, {
+        VAR_LOG_PORT: DEFAULT_INTERNAL_LOG_PORT,
+        VAR_EDITOR_PORT: DEFAULT_INTERNAL_EDITOR_PORT,
+        VAR_PROXY_PORT: DEFAULT_INTERNAL_PROXY_PORT,
+        VAR_INTERNAL_LOG_PORT: DEFAULT_INTERNAL_LOG_PORT,
+        VAR_INTERNAL_EDITOR_PORT: DEFAULT_INTERNAL_EDITOR_PORT,
+        VAR_INTERNAL_PROXY_PORT: DEFAULT_INTERNAL_PROXY_PORT,
+        VAR_EXTERNAL_LOG_PORT: external_log_port,
+        VAR_EXTERNAL_EDITOR_PORT: external_editor_port,
+        VAR_EXTERNAL_PROXY_PORT: external_proxy_port,
+        VAR_GIT_REPO: up_request['repo'],
+        VAR_ALLOW_ORIGIN: allow_origin or '',
+        VAR_VOLUME_NAME: volume_name,
+        VAR_NODE_NAME: environment.node
+    })
+    project = get_project('./', project_name, dest_file_name, config)
+    print('Running docker-compose up for environment {}...'.format(environment.id))
+    set_job_phase(job, 'creating', up_request)
+    with docker_call_latency.time(call='project.up'):
+        if reuse:
+            affinity_ups.inc(result='restarted')
+            project.up(detached=True, strategy=1)  # strategy 1 = re-create only if changed
+        else:
+            affinity_ups.inc(result='deployed')
+            project.up(detached=True, strategy=2)  # strategy 2 = always re-create
+    container_states.invalidate()
     ps = ps_(project)
-    return get_up_details(ps, docker_compose_dict, minienv_dict)
+    details = get_up_details(ps, docker_compose_dict, minienv_config, get_node_host_name(environment),
+                             content_digest)
+    set_job_phase(job, 'ready', up_request)
+    return details
+
+
+def set_job_phase(job, phase, up_request):
+    if job is not None:
+        job.phase = phase
+        progress.publish(up_request['claimToken'], 'phase', {'jobId': job.id, 'phase': phase})
 
 
 def is_env_deployed(env_id):
     project_name = get_env_project_name(env_id)
     project_file_name = './docker-compose-{}.yml'.format(project_name)
     if os.path.isfile(project_file_name):
-        project = get_project('./', project_name, project_file_name)
-        ps = ps_(project)
+        ps = container_states.get(project_name)
         return is_project_starting(ps) or is_project_running(ps)
     else:
         return False
@@ -312,91 +636,119 @@ def is_env_deployed(env_id):
 def delete_env(env_id):
     project_name = get_env_project_name(env_id)
     project_file_name = './docker-compose-{}.yml'.format(project_name)
+    if not os.path.isfile(project_file_name):
+        return
     project = get_project('./', project_name, project_file_name)
     ps = ps_(project)
     if is_project_running(ps):
-        project.down(1, True, remove_orphans=True)
-    wait_time = 0
-    while is_project_running(ps) and wait_time < 120:
-        print('Waiting for environment {} deletion...'.format(env_id))
-        wait_time = wait_time + 15
-        time.sleep(15)
-        ps = ps_(project)
+        # down stops and removes the containers before it returns
+        with docker_call_latency.time(call='project.down'):
+            project.down(1, True, remove_orphans=True)
+        container_states.invalidate()
+        if is_project_running(ps_(project)):
+            raise TeardownError('Environment {} still running after down'.format(env_id))
     os.remove(project_file_name)
+    invalidate_project(project_name)
+
+
+def teardown_env(env_id):
+    return request_teardown(get_env_project_name(env_id), delete_env, env_id)
+
+
+def teardown_provisioner(env_id):
+    return request_teardown(get_provisioner_project_name(env_id), delete_provisioner, env_id)
+
+
+def teardown_environment(env_id):
+    return request_teardown(get_volume_name(env_id), delete_environment_resources, env_id)
+
+
+def teardown_environments(env_ids, timeout=None):
+    # tear down many environments at once; returns the ids that did not finish cleanly
+    jobs = [(env_id, teardown_environment(env_id)) for env_id in env_ids]
+    failed = []
+    for env_id, job in jobs:
+        if not job.wait(timeout) or job.error is not None:
+            failed.append(env_id)
+    return failed
+
 
+def request_teardown(key, fn, *args):
+    # teardowns run on their own bounded pool; a request for something that is
+    # already being torn down joins the in-flight job
+    with teardown_jobs_lock:
+        job = teardown_jobs.get(key)
+        if job is not None and not job.done():
+            return job
+        job = teardown_pool.submit(run_with_retries, key, fn, *args)
+        teardown_jobs[key] = job
+    job.add_done_callback(lambda finished: forget_teardown(key, finished))
+    return job
 
-def get_up_details(ps, docker_compose_dict, minienv_dict):
+
+def forget_teardown(key, job):
+    with teardown_jobs_lock:
+        if teardown_jobs.get(key) is job:
+            del teardown_jobs[key]
+
+
+def run_with_retries(key, fn, *args):
+    attempt = 0
+    while True:
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt >= teardown_retries:
+                print('Teardown of {} failed: {}'.format(key, e))
+                raise
+            attempt += 1
+            print('Teardown of {} failed ({}); retry {} of {}...'.format(key, e, attempt, teardown_retries))
+            time.sleep(2 ** attempt)
+
+
+def get_node_host_name(environment):
+    node = placement.nodes.get(environment.node)
+    return node.host if node is not None else node_host_name
+
+
+def get_up_details(ps, docker_compose_dict, minienv_config, node_host_name, content_digest=None):
     details = {'node_host_name': node_host_name}
-    tabs = []
     if len(ps) > 0 and 'ports' in ps[0].keys():
         ports = ps[0]['ports']
         for key in ports.keys():
-            port_str = key[0:key.index('/')]
+            port_str = key.split('/')[0]
             if ports[key] is not None and len(ports[key]) > 0:
-                host_port_str = ports[key][0]['HostPort']
-                host_port = int(host_port_str)
+                host_port = int(ports[key][0]['HostPort'])
                 if port_str == DEFAULT_INTERNAL_LOG_PORT:
                     details['logPort'] = host_port
                     details['logUrl'] = 'http://{}:{}'.format(node_host_name, host_port)
                 elif port_str == DEFAULT_INTERNAL_EDITOR_PORT:
                     details['editorPort'] = host_port
                     details['editorUrl'] = 'http://{}:{}'.format(node_host_name, host_port)
-                    if 'editor' in minienv_dict.keys():
-                        editor = minienv_dict['editor']
-                        if 'hide' in editor.keys() and editor['hide']:
-                            details['editorPort'] = 0
-                            details['editorUrl'] = ''
-                        elif 'srcDir' in editor.keys() and len(editor['srcDir']) > 0:
-                            details['editorUrl'] = '{}?src={}'.format(details['editorUrl'], urllib.quote(editor['srcDir']))
+                    if minienv_config.editor_hidden:
+                        details['editorPort'] = 0
+                        details['editorUrl'] = ''
+                    elif len(minienv_config.editor_src_dir) > 0:
+                        details['editorUrl'] = '{}?src={}'.format(details['editorUrl'],
+                                                                  urllib.quote(minienv_config.editor_src_dir))
                 elif port_str == DEFAULT_INTERNAL_PROXY_PORT:
                     details['proxyPort'] = host_port
-    proxy_ports = []
-    if 'proxy' in minienv_dict.keys():
-        if 'ports' in minienv_dict['proxy'].keys():
-            proxy_ports = minienv_dict['proxy']['ports']
-    if 'services' in docker_compose_dict.keys():
-        services = docker_compose_dict['services']
-        for key in services.keys():
-            if 'ports' in services[key].keys():
-                ports = services[key]['ports']
-                if ports is not None and len(ports) > 0:
-                    for port_str in ports:
-                        tab_port_str = port_str[0:port_str.index(':')]
-                        tab_port = int(tab_port_str)
-                        tab = {'port': tab_port, 'name': tab_port_str, 'path': ''}
-                        extra_tabs = []
-                        hide_tab = False
-                        for proxy_port in proxy_ports:
-                            if 'port' in proxy_port.keys() and proxy_port['port'] == tab_port:
-                                if 'hide' in proxy_port.keys() and proxy_port['hide']:
-                                    hide_tab = True
-                                    break
-                                if 'tabs' in proxy_port.keys() and len(proxy_port['tabs']) > 0:
-                                    for i, proxy_tab in enumerate(proxy_port['tabs']):
-                                        if i == 0:
-                                            if 'name' in proxy_tab.keys():
-                                                tab['name'] = proxy_tab['name']
-                                            if 'path' in proxy_port.keys():
-                                                tab['path'] = proxy_port['path']
-                                        else:
-                                            extra_tab = {'port': tab_port, 'name': tab_port_str, 'path': ''}
-                                            if 'name' in proxy_tab.keys():
-                                                extra_tab['name'] = proxy_tab['name']
-                                            if 'path' in proxy_port.keys():
-                                                extra_tab['path'] = proxy_port['path']
-                                            extra_tabs.append(extra_tab)
-                                else:
-                                    if 'name' in proxy_port.keys():
-                                        tab['name'] = proxy_port['name']
-                                    if 'path' in proxy_port.keys():
-                                        tab['path'] = proxy_port['path']
-                        if not hide_tab:
-                            tabs.append(tab)
-                            if len(extra_tabs) > 0:
-                                tabs.extend(extra_tabs)
-    for tab in tabs:
-        tab['url'] = 'http://{}.{}:{}{}'.format(tab['port'], node_host_name, details['proxyPort'], tab['path'])
-    details['tabs'] = tabs
+    proxy_port = details.get('proxyPort')
+
+    def compute_tabs():
+        tabs = get_tabs(docker_compose_dict, minienv_config)
+        for tab in tabs:
+            if proxy_port is None:
+                tab['url'] = ''
+            else:
+                tab['url'] = 'http://{}.{}:{}{}'.format(tab['port'], node_host_name, proxy_port, tab['path'])
+        return tabs
+
+    if content_digest is None:
+        details['tabs'] = compute_tabs()
+    else:
+        # same repo content on the same node and port block gives the same tabs
+        details['tabs'] = up_tabs.get((content_digest, node_host_name, proxy_port), compute_tabs)
     return details
 
 
@@ -427,90 +779,416 @@ def get_volume_name(env_id):
     return 'minienv-env-{}-volume'.format(env_id.lower())
 
 
+def parse_project_label(project_label):
+    # returns (env_id, is_provisioner) or (None, False) for projects that aren't ours
+    match = PROJECT_LABEL_PATTERN.match(project_label)
+    if match is None:
+        return None, False
+    return match.group(1), match.group(2) is not None
+
+
 def init_environments(env_count):
-    print('Provisioning {} environments...'.format(env_count))
-    for i in range(0, env_count):
-        environment = {
-            'id': str(i + 1),
-            'index': i,
-            'status': STATUS_IDLE,
-            'claimToken': '',
-            'lastActivity': 0,
-            'repo': None,
-            'upResponse': None,
-        }
-        environments.append(environment)
-        # check if environment running
-        running = False
-        if is_env_deployed(environment['id']):
-            print('Loading running environment {}...'.format(environment['id']))
-            environment['status'] = STATUS_RUNNING
-            # TODO: environment.ClaimToken =
-            environment['lastActivity'] = time.time()
-            # TODO: environment.UpRequest = ???
-            # TODO: environment.UpResponse = ???
-            # running = True
-        if not running:
-            print('Provisioning environment {}...'.format(environment['id']))
-            environment['status'] = STATUS_PROVISIONING
-            deploy_provisioner(environment)
-            wait_time = 0
-            while is_provisioner_running(environment['id']) and wait_time < 120:
-                wait_time = wait_time + 15
-                time.sleep(15)
+    environments.add_listener(schedule_expiry)
+    environments.add_listener(end_progress)
+    expiry_scheduler.start()
+    if state_store is not None:
+        recover_environments()
+    print('Provisioning {} environments...'.format(max(0, env_count - len(environments))))
+    for i in range(len(environments), env_count):
+        add_environment()
+    if health_mode == HEALTH_MODE_EVENTS:
+        print('Watching docker events; reconciling every {} seconds.'.format(reconcile_seconds))
+        EventWatcher(docker_client, handle_container_event).start()
     start_environment_check_timer()
 
 
+def recover_environments():
+    state_dir = os.path.dirname(os.path.abspath(state_file))
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    if not is_on_volume(state_dir):
+        print('WARNING: state file {} is not on a mounted volume; environments will not be recovered '
+              'once this container is replaced.'.format(state_file))
+    saved = state_store.load()
+    # record every change from here on, including the fix-ups made while recovering
+    environments.add_listener(persist_environment)
+    state_store.start()
+    if len(saved) == 0:
+        return
+    print('Recovering {} environments...'.format(len(saved)))
+    now = time.time()
+    # re-take every recorded slot before anything is placed anew
+    placed = set(values['id'] for values in saved
+                 if placement.restore(values['id'], values['node'], values['slot']) is not None)
+    for values in saved:
+        recover_environment(values, values['id'] in placed, now)
+
+
+def is_on_volume(path):
+    # inside a container the root filesystem is always a mount, so only a
+    # mount below it counts
+    while path != os.path.dirname(path):
+        if os.path.ismount(path):
+            return True
+        path = os.path.dirname(path)
+    return False
+
+
+def recover_environment(values, placed, now):
+    environment = Environment(values['id'], values['index'], values['status'])
+    for name in ('claim_token', 'repo', 'details', 'up_request', 'warm_details', 'node', 'slot'):
+        setattr(environment, name, values[name] if values[name] is not None else getattr(environment, name))
+    deployed = is_env_deployed(environment.id)
+    if not placed:
+        # its node was dropped from MINIENV_NODES (or its slot is taken);
+        # start over somewhere else
+        print('Environment {} lost its placement on node {}.'.format(environment.id, environment.node))
+        environment.status = STATUS_PROVISIONING
+        environment.claim_token = ''
+        environment.node = None
+        environment.slot = None
+        deployed = False
+    if not deployed:
+        environment.repo = None
+        environment.details = None
+        environment.warm_details = None
+    if environment.status == STATUS_UPDATING or (environment.status == STATUS_RUNNING and not deployed):
+        # the deployment was interrupted or has gone away; the client keeps
+        # its claim and can bring the repo up again
+        environment.status = STATUS_CLAIMED
+        environment.up_request = None
+        environment.details = None
+        environment.warm_details = None
+    if environment.status != STATUS_PROVISIONING and not deployed and not is_volume_present(environment.id):
+        environment.status = STATUS_PROVISIONING
+        environment.claim_token = ''
+    if environment.status in (STATUS_CLAIMED, STATUS_RUNNING):
+        # pings are not persisted, so give clients a full timeout to reconnect
+        environment.last_activity = now
+    print('Recovered environment {}; status={}'.format(environment.id, STATUS_NAMES[environment.status]))
+    environments.restore(environment)
+    if environment.node is None and not place_environment(environment):
+        print('No node has room for environment {}.'.format(environment.id))
+        environments.remove(environment, STATUS_PROVISIONING)
+        return
+    if environment.status == STATUS_PROVISIONING:
+        environment.provision_job = provision_pool.submit(provision_environment, environment)
+
+
+def persist_environment(environment):
+    if environments.get(environment.id) is environment:
+        state_store.save(environment)
+    else:
+        state_store.delete(environment.id)
+
+
+def is_volume_present(env_id):
+    try:
+        docker_client.volumes.get(get_volume_name(env_id))
+        return True
+    except docker.errors.NotFound:
+        return False
+
+
+def schedule_expiry(environment):
+    # claims expire, and running environments go idle, after a period without pings
+    if environment.status == STATUS_CLAIMED:
+        expiry_scheduler.schedule(environment.id, environment.last_activity + EXPIRE_CLAIM_NO_ACIVITY_SECONDS)
+    elif environment.status == STATUS_RUNNING:
+        expiry_scheduler.schedule(environment.id, environment.last_activity + DELETE_ENV_NO_ACIVITY_SECONDS)
+    else:
+        expiry_scheduler.cancel(environment.id)
+
+
+def expire_environment(env_id):
+    environment = environments.get(env_id)
+    if environment is None:
+        return
+    # snapshot what we base the decision on; the release below only
+    # applies if no request handler changed the environment in between
+    status = environment.status
+    claim_token = environment.claim_token
+    last_activity = environment.last_activity
+    if status == STATUS_CLAIMED:
+        timeout = EXPIRE_CLAIM_NO_ACIVITY_SECONDS
+    elif status == STATUS_RUNNING:
+        timeout = DELETE_ENV_NO_ACIVITY_SECONDS
+    else:
+        return
+    if time.time() - last_activity < timeout:
+        schedule_expiry(environment)
+    elif status == STATUS_CLAIMED:
+        print('Environment {} claim expired.'.format(environment.id))
+        environments.release(environment, STATUS_CLAIMED, claim_token, last_activity)
+    else:
+        print('Environment {} no longer active.'.format(environment.id))
+        environments.release(environment, STATUS_RUNNING, claim_token, last_activity)
+
+
+expiry_scheduler = DeadlineScheduler(expire_environment)
+
+
+def handle_container_event(project_label, action):
+    # keep the container cache current, then react to deployments going away
+    container_states.invalidate()
+    env_id, is_provisioner = parse_project_label(project_label)
+    environment = environments.get(env_id) if env_id is not None else None
+    if environment is None or action == 'start':
+        return
+    if is_provisioner:
+        # provisioners exit once the images are loaded; only pick up the ones
+        # whose worker gave up waiting, the others complete on their own
+        if environment.status == STATUS_PROVISIONING and environment.provision_job is not None \
+                and environment.provision_job.done():
+            resume_provisioning(environment)
+    elif environment.status == STATUS_RUNNING:
+        # our own teardowns happen while the environment is UPDATING, so only
+        # unexpected exits get here
+        if not is_env_deployed(environment.id):
+            print('Environment {} no longer deployed.'.format(environment.id))
+            environments.release(environment, STATUS_RUNNING, environment.claim_token, repo=None,
+                                 warm_details=None)
+
+
+def add_environment():
+    environment = environments.create(STATUS_PROVISIONING)
+    if not place_environment(environment):
+        print('No node has room for another environment.')
+        environments.remove(environment, STATUS_PROVISIONING)
+        return None
+    # provisioning runs in the background; the environment stays in
+    # STATUS_PROVISIONING (and cannot be claimed) until it completes
+    environment.provision_job = provision_pool.submit(provision_environment, environment)
+    return environment
+
+
+def place_environment(environment):
+    # spread by free slots, then by how many environments are in use on each node
+    loads = {}
+    for status in (STATUS_CLAIMED, STATUS_RUNNING, STATUS_UPDATING):
+        for other in environments.with_status(status):
+            loads[other.node] = loads.get(other.node, 0) + 1
+    placed = placement.place(environment.id, loads)
+    if placed is None:
+        return False
+    node, slot = placed
+    print('Placing environment {} on node {}; slot={}'.format(environment.id, node.name, slot))
+    return environments.transition(environment, environment.status, environment.status, node=node.name, slot=slot)
+
+
+def remove_environments(candidates, from_status=STATUS_IDLE):
+    # the index (and so the id, project names and volume) and the node slot
+    # stay reserved until the teardown finishes, so a new environment cannot
+    # be created on top of resources that are about to be destroyed
+    removed = [environment for environment in candidates
+               if environments.remove(environment, from_status, free_index=False)]
+    if len(removed) > 0:
+        print('Removing environments {}...'.format(', '.join(environment.id for environment in removed)))
+        for environment in removed:
+            teardown_environment(environment.id).add_done_callback(
+                lambda job, env_id=environment.id, index=environment.index: finish_removal(env_id, index, job))
+    return [environment.id for environment in removed]
+
+
+def finish_removal(env_id, index, job):
+    if job.error is not None:
+        # leave the index and slot reserved rather than hand out an id whose
+        # resources may still exist
+        print('Environment {} not torn down; keeping its index and slot reserved.'.format(env_id))
+        return
+    placement.release(env_id)
+    environments.free_index(index)
+
+
+def delete_environment_resources(env_id):
+    delete_env(env_id)
+    delete_provisioner(env_id)
+    try:
+        docker_client.volumes.get(get_volume_name(env_id)).remove()
+    except docker.errors.NotFound:
+        pass
+
+
+def autoscale_environments():
+    global pool_last_growth
+    available = environments.count(STATUS_IDLE) + environments.count(STATUS_PROVISIONING)
+    if available < pool_min_idle and len(environments) < pool_max_size:
+        count = min(pool_min_idle - available, pool_max_size - len(environments))
+        print('Growing pool by {} environments...'.format(count))
+        for i in range(0, count):
+            add_environment()
+        pool_last_growth = time.time()
+    elif time.time() - pool_last_growth > pool_cooldown_seconds:
+        # shrink in one batch, highest port blocks first
+        surplus = min(environments.count(STATUS_IDLE) - pool_min_idle, len(environments) - pool_min_size)
+        if surplus > 0:
+            idle = sorted(environments.with_status(STATUS_IDLE), key=lambda e: e.index)
+            remove_environments(idle[-surplus:])
+
+
+def provision_environment(environment, images=None):
+    print('Provisioning environment {}...'.format(environment.id))
+    environments.set_status(environment, STATUS_PROVISIONING)
+    if images is None:
+        images = get_static_images()
+    deploy_provisioner(environment, images)
+    complete_provisioning(environment, images)
+
+
+def complete_provisioning(environment, images=None):
+    # runs as the environment's provision_job, so nothing else picks the
+    # environment up while it decides what happens next
+    exit_code = wait_for_provisioner(environment.id)
+    if exit_code is None:
+        # leave it to check_environments to pick up
+        print('Environment {} still provisioning...'.format(environment.id))
+        return
+    if exit_code == 0:
+        fields = {'images': images} if images is not None else {}
+        if environments.transition(environment, STATUS_PROVISIONING, STATUS_IDLE, provision_failures=0, **fields):
+            print('Environment {} provisioning complete.'.format(environment.id))
+            teardown_provisioner(environment.id)
+        return
+    # an environment without its images must never be handed out
+    environment.provision_failures += 1
+    if environment.provision_failures > provision_retries:
+        print('Environment {} failed to provision {} times; removing it.'.format(
+            environment.id, environment.provision_failures))
+        remove_environments([environment], STATUS_PROVISIONING)
+    else:
+        # a failed prewarm falls back to the images the environment already had
+        retry_images = environment.images if environment.images is not None else get_static_images()
+        print('Reprovisioning environment {}...'.format(environment.id))
+        environment.provision_job = provision_pool.submit(provision_environment, environment, retry_images)
+    raise ProvisionError('Provisioner for environment {} exited with status {}'.format(environment.id, exit_code))
+
+
+def resume_provisioning(environment):
+    # the provisioner outlived its worker's wait and has since exited
+    with provision_lock:
+        job = environment.provision_job
+        if environment.status != STATUS_PROVISIONING or (job is not None and not job.done()):
+            return
+        environment.provision_job = provision_pool.submit(complete_provisioning, environment)
+
+
+def get_static_images():
+    return [image.strip() for image in provision_images.split(',') if len(image.strip()) > 0]
+
+
+def prewarm_environments():
+    # re-run the provisioner on idle environments, adding the images up
+    # requests ask for most, so the next up finds them already loaded
+    global last_prewarm
+    prewarm_jobs[:] = [job for job in prewarm_jobs if not job.done()]
+    if prewarm_image_count <= 0 or time.time() - last_prewarm < prewarm_interval_seconds:
+        return
+    wanted = image_demand.top(prewarm_image_count)
+    if len(wanted) == 0 or environments.queue_length() > 0:
+        return
+    # idle environments with a deployment still on them are kept for reuse
+    candidates = [environment for environment in environments.with_status(STATUS_IDLE)
+                  if environment.warm_details is None and get_coverage(environment.images, wanted) < 1]
+    candidates.sort(key=lambda e: get_coverage(e.images, wanted))
+    available = min(prewarm_parallelism - len(prewarm_jobs), environments.count(STATUS_IDLE) - prewarm_reserve)
+    for environment in candidates[:max(0, available)]:
+        images = list(environment.images if environment.images is not None else get_static_images())
+        # cap the downloads a single run adds
+        images.extend([image for image in wanted if image not in images][:prewarm_max_new_images])
+        if not environments.transition(environment, STATUS_IDLE, STATUS_PROVISIONING):
+            continue
+        print('Pre-warming environment {} with {}...'.format(environment.id, ', '.join(images)))
+        environment.provision_job = prewarm_pool.submit(provision_environment, environment, images)
+        environment.provision_job.add_done_callback(
+            lambda job: prewarm_runs.inc(result='failed' if job.error is not None else 'done'))
+        prewarm_jobs.append(environment.provision_job)
+        last_prewarm = time.time()
+
+
+def wait_for_provisioner(env_id):
+    # block on the provisioner containers exiting rather than polling; the
+    # highest exit status, or None if they could not be waited on
+    project_name = get_provisioner_project_name(env_id)
+    project_file_name = './docker-compose-{}.yml'.format(project_name)
+    project = get_project('./', project_name, project_file_name)
+    exit_code = 0
+    for container in project.containers(stopped=True):
+        try:
+            result = docker_client.api.wait(container.id, timeout=provision_timeout_seconds)
+        except Exception as e:
+            print('Error waiting for provisioner {}: {}'.format(env_id, e))
+            return None
+        # docker-py 2 returns the status code, later versions the whole response
+        exit_code = max(exit_code, result['StatusCode'] if isinstance(result, dict) else result)
+    return exit_code
+
+
 def start_environment_check_timer():
     t = Timer(CHECK_ENV_TIMER_SECONDS, check_environments)
+    # must not keep the process alive once the server has shut down
+    t.daemon = True
     t.start()
 
 
 def check_environments():
-    for environment in environments:
-        print('Checking environment {}; current status={}'.format(environment['id'], environment['status']))
-        if environment['status'] == STATUS_PROVISIONING:
-            # TODO: not supported yet
-            if not is_provisioner_running(environment['id']):
-                print('Environment {} provisioning complete.'.format(environment['id']))
-                environment['status'] = STATUS_IDLE
-                delete_provisioner(environment['id'])
-            else:
-                print('Environment {} still provisioning...'.format(environment['id']))
-        elif environment['status'] == STATUS_RUNNING:
-            if time.time() - environment['lastActivity'] > DELETE_ENV_NO_ACIVITY_SECONDS:
-                print('Environment {} no longer active.'.format(environment['id']))
-                environment['status'] = STATUS_IDLE
-                environment['claimToken'] = ''
-                environment['lastActivity'] = 0
-                environment['upRequest'] = None
-                environment['details'] = None
-                (environment['id'])
-            else:
-                print('Checking if environment {} is still deployed...'.format(environment['id']))
-                if not is_env_deployed(environment['id']):
-                    print('Environment {} no longer deployed.'.format(environment['id']))
-                    environment['status'] = STATUS_IDLE
-                    environment['claimToken'] = ''
-                    environment['lastActivity'] = 0
-                    environment['upRequest'] = None
-                    environment['details'] = None
-        elif environment['status'] == STATUS_CLAIMED:
-            if time.time() - environment['lastActivity'] > EXPIRE_CLAIM_NO_ACIVITY_SECONDS:
-                print('Environment {} claim expired.'.format(environment['id']))
-                environment['status'] = STATUS_IDLE
-                environment['claimToken'] = ''
-                environment['lastActivity'] = 0
-                environment['upRequest'] = None
-                environment['details'] = None
-    start_environment_check_timer()
+    # one failed pass (e.g. a docker error) must not stop the checks for good
+    try:
+        run_environment_check()
+    except Exception as e:
+        print('Error checking environments: {}'.format(e))
+    finally:
+        start_environment_check_timer()
+
+
+def run_environment_check():
+    global last_reconcile
+    start_time = time.time()
+    # in events mode the per-environment docker checks are only a slow safety net
+    reconcile = health_mode != HEALTH_MODE_EVENTS or start_time - last_reconcile >= reconcile_seconds
+    if reconcile:
+        last_reconcile = start_time
+    for environment in environments.with_status(STATUS_PROVISIONING):
+        print('Checking environment {}; current status={}'.format(environment.id, environment.status))
+        if environment.provision_job is not None and not environment.provision_job.done():
+            print('Environment {} still provisioning...'.format(environment.id))
+        elif not reconcile:
+            continue
+        elif not is_provisioner_running(environment.id):
+            resume_provisioning(environment)
+        else:
+            print('Environment {} still provisioning...'.format(environment.id))
+    # claim and inactivity expiry are driven by expiry_scheduler
+    if reconcile:
+        for environment in environments.with_status(STATUS_RUNNING):
+            print('Checking if environment {} is still deployed...'.format(environment.id))
+            claim_token = environment.claim_token
+            if not is_env_deployed(environment.id):
+                print('Environment {} no longer deployed.'.format(environment.id))
+                environments.release(environment, STATUS_RUNNING, claim_token, repo=None, warm_details=None)
+    environments.expire_waiters(time.time() - EXPIRE_CLAIM_TICKET_NO_ACIVITY_SECONDS)
+    autoscale_environments()
+    prewarm_environments()
+    check_duration.set(time.time() - start_time)
+
+
+def shutdown():
+    if teardown_on_shutdown:
+        print('Tearing down {} environments...'.format(len(environments)))
+        teardown_environments([environment.id for environment in environments])
+    if state_store is not None:
+        state_store.close()
+
 
 if __name__ == '__main__':
     try:
         port = int(os.getenv('PORT', 8080))
-        env_count = int(os.getenv('MINIENV_PROVISION_COUNT', 1))
-        init_environments(env_count)
+        init_environments(pool_min_size)
         server = pywsgi.WSGIServer(('', port), app)
+        # docker stop and swarm task replacement send SIGTERM; stopping the
+        # server returns from serve_forever so the shutdown below still runs
+        gevent.signal(signal.SIGTERM, server.stop)
         server.serve_forever()
     except (KeyboardInterrupt, SystemExit):
         pass
+    print('Shutting down...')
+    shutdown()
@@ -0,0 +1,40 @@
+"""
+docker backends: the real daemon, or an in-memory fake for load testing
+"""
+
+BACKEND_DOCKER = 'docker'
+BACKEND_FAKE = 'fake'
+
+
+class Backend(object):
+    """
+    everything the api needs from docker: a docker sdk style client (with
+    .api, .volumes and .events) and the compose bridge functions. repo_files
+    replaces the api's repo file cache when set
+    """
+
+    def __init__(self, client, get_project, ps_, invalidate_project, repo_files=None):
+        self.client = client
+        self.get_project = get_project
+        self.ps_ = ps_
+        self.invalidate_project = invalidate_project
+        self.repo_files = repo_files
+
+
+def load_backend(name, fake_latencies='', fake_repo_dir=None):
+    """
+    the backend called name; fake_latencies configures the fake, see
+    fake_backend.parse_latencies, and fake_repo_dir holds the repo files it serves
+    """
+    if name == BACKEND_DOCKER:
+        import docker
+        import docker_compose
+        return Backend(docker.from_env(), docker_compose.get_project, docker_compose.ps_,
+                       docker_compose.invalidate_project)
+    if name == BACKEND_FAKE:
+        from fake_backend import FakeDocker, FakeRepoFiles, parse_latencies
+        latencies = parse_latencies(fake_latencies)
+        fake = FakeDocker(latencies)
+        return Backend(fake, fake.get_project, fake.ps_, fake.invalidate_project,
+                       FakeRepoFiles(latencies, fake_repo_dir))
+    raise ValueError('Unknown backend \'{}\''.format(name))
@@ -0,0 +1,62 @@
+"""
+end-to-end load test of the api under pywsgi with the fake docker backend:
+claim every environment, ping the claims, then bring a repo up on each and
+wait for it to be ready
+
+    python bench/benchmark.py --environments 20 --pings 5000 --latencies up=1,ps=0.01
+
+reports p50, p99 and throughput for each phase; repo files come from the
+fake backend, so nothing leaves the machine
+"""
+
+import argparse
+import time
+from harness import Server, post, report, run_concurrently
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--environments', type=int, default=20)
+    parser.add_argument('--pings', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latencies', default='up=1,down=0.5,ps=0.01,containers=0.01',
+                        help='fake docker latencies, see fake_backend.parse_latencies')
+    parser.add_argument('--ready-timeout', type=float, default=120)
+    parser.add_argument('--port', type=int, default=18080)
+    args = parser.parse_args()
+
+    server = Server(args.environments, args.port, args.latencies).start()
+    try:
+        url = server.url('/api/claim')
+        results, elapsed = run_concurrently(lambda i: post(url, {}), range(0, args.environments), args.concurrency)
+        report('claim', [seconds for seconds, response in results], elapsed)
+        tokens = [response['claimToken'] for seconds, response in results if response['claimGranted']]
+        if len(tokens) != args.environments:
+            raise Exception('Only {} of {} claims granted'.format(len(tokens), args.environments))
+
+        url = server.url('/api/ping')
+        results, elapsed = run_concurrently(lambda i: post(url, {'claimToken': tokens[i % len(tokens)]}),
+                                            range(0, args.pings), args.concurrency)
+        report('ping', [seconds for seconds, response in results], elapsed)
+
+        def up(i):
+            seconds, response = post(server.url('/api/up'), {
+                'claimToken': tokens[i], 'repo': 'https://github.com/minienv/example-{}'.format(i)})
+            start_time = time.time() - seconds
+            deadline = start_time + args.ready_timeout
+            while time.time() < deadline:
+                ping_seconds, ping_response = post(server.url('/api/ping'), {'claimToken': tokens[i]})
+                if ping_response['up']:
+                    return seconds, time.time() - start_time
+                time.sleep(0.1)
+            raise Exception('Environment for claim {} not up after {} seconds'.format(i, args.ready_timeout))
+
+        results, elapsed = run_concurrently(up, range(0, len(tokens)), args.concurrency)
+        report('up (request)', [seconds for seconds, ready in results], elapsed)
+        report('up (time to ready)', [ready for seconds, ready in results], elapsed)
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+discrete-event simulation of the claim queue under oversubscription: clients
+arrive at random, claim or queue, poll their ticket until it is granted, hold
+the environment for a while and release it
+
+    python bench/claim_queue_sim.py --environments 50 --load 0.8,1.0,1.2,1.5
+
+load is the offered load, arrival rate * mean hold time / environments; above
+1.0 the queue only stays bounded because clients give up. runs against the
+real EnvironmentRegistry on a simulated clock, so a simulated day takes
+seconds
+"""
+
+import argparse
+import heapq
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from environments import EnvironmentRegistry, STATUS_CLAIMED, STATUS_IDLE  # noqa: E402
+from harness import percentile  # noqa: E402
+
+ARRIVE = 0
+POLL = 1
+RELEASE = 2
+CHECK = 3
+
+
+class Simulation(object):
+
+    def __init__(self, args, load, seed):
+        self.args = args
+        self.random = random.Random(seed)
+        self.arrival_interval = args.hold / (load * args.environments)
+        self.environments = EnvironmentRegistry()
+        for i in range(0, args.environments):
+            self.environments.create(STATUS_IDLE)
+        self.events = []
+        self.seq = 0
+        self.next_client = 0
+        self.waits = []
+        self.abandoned = 0
+        self.max_queue = 0
+        self.busy_seconds = 0
+        # claim tokens whose owners are using their environment (and pinging)
+        self.holding = set()
+        self.expired_claims = 0
+
+    def schedule(self, at, kind, data=None):
+        # seq breaks ties so events at the same instant run in schedule order
+        heapq.heappush(self.events, (at, self.seq, kind, data))
+        self.seq += 1
+
+    def run(self):
+        self.schedule(self.random.expovariate(1.0 / self.arrival_interval), ARRIVE)
+        self.schedule(self.args.check_interval, CHECK)
+        while len(self.events) > 0:
+            now, seq, kind, data = heapq.heappop(self.events)
+            if now > self.args.duration:
+                break
+            if kind == ARRIVE:
+                self.arrive(now)
+            elif kind == POLL:
+                self.poll(now, *data)
+            elif kind == RELEASE:
+                self.release(now, *data)
+            else:
+                self.check(now)
+        return self
+
+    def check(self, now):
+        # what the app's environment check does: expire tickets and claims
+        # nobody is polling any more
+        self.environments.expire_waiters(now - self.args.ticket_timeout)
+        for environment in self.environments.with_status(STATUS_CLAIMED):
+            if environment.claim_token not in self.holding and \
+                    environment.last_activity < now - self.args.claim_timeout:
+                self.expired_claims += 1
+                self.release(now, environment, environment.claim_token, now)
+        self.schedule(now + self.args.check_interval, CHECK)
+
+    def arrive(self, now):
+        self.schedule(now + self.random.expovariate(1.0 / self.arrival_interval), ARRIVE)
+        client = self.next_client
+        self.next_client += 1
+        claim_token = 'claim-{}'.format(client)
+        environment = self.environments.claim(claim_token, now)
+        if environment is not None:
+            self.granted(now, now, environment, claim_token)
+            return
+        self.environments.enqueue('ticket-{}'.format(client), claim_token, now)
+        self.max_queue = max(self.max_queue, self.environments.queue_length())
+        self.schedule(now + self.args.poll, POLL, ('ticket-{}'.format(client), now))
+
+    def poll(self, now, ticket, arrived):
+        if now - arrived > self.args.patience:
+            # the client gives up and stops polling; its ticket expires on a later check
+            self.abandoned += 1
+            return
+        waiter = self.environments.find_ticket(ticket, now)
+        if waiter is None:
+            self.abandoned += 1
+        elif waiter.environment is None:
+            self.schedule(now + self.args.poll, POLL, (ticket, arrived))
+        else:
+            self.granted(now, arrived, waiter.environment, waiter.claim_token)
+
+    def granted(self, now, arrived, environment, claim_token):
+        self.waits.append(now - arrived)
+        self.holding.add(claim_token)
+        hold = self.random.expovariate(1.0 / self.args.hold)
+        self.schedule(now + hold, RELEASE, (environment, claim_token, now))
+
+    def release(self, now, environment, claim_token, granted):
+        self.busy_seconds += now - granted
+        self.holding.discard(claim_token)
+        # hands the environment straight to the head of the queue, if any
+        self.environments.release(environment, STATUS_CLAIMED, claim_token)
+        if environment.claim_token:
+            # hand-offs stamp wall-clock time; move it onto the simulated clock
+            environment.last_activity = now
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--environments', type=int, default=50)
+    parser.add_argument('--load', default='0.8,0.95,1.0,1.2,1.5')
+    parser.add_argument('--hold', type=float, default=600, help='mean seconds a client keeps an environment')
+    parser.add_argument('--poll', type=float, default=5, help='seconds between ticket polls')
+    parser.add_argument('--patience', type=float, default=900, help='seconds a client waits before giving up')
+    parser.add_argument('--ticket-timeout', type=float, default=30)
+    parser.add_argument('--claim-timeout', type=float, default=30)
+    parser.add_argument('--check-interval', type=float, default=15)
+    parser.add_argument('--duration', type=float, default=8 * 3600)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    for load in [float(value) for value in args.load.split(',')]:
+        sim = Simulation(args, load, args.seed).run()
+        waits = sim.waits
+        print('load={:<5} clients={:<6} served={:<6} abandoned={:<6} expired claims={:<5} '
+              'p50={:7.1f}s p99={:7.1f}s max={:7.1f}s max queue={:<5} utilization={:5.1f}%'.format(
+                  load, sim.next_client, len(waits), sim.abandoned, sim.expired_claims, percentile(waits, 50),
+                  percentile(waits, 99), max(waits) if len(waits) > 0 else 0, sim.max_queue,
+                  100.0 * sim.busy_seconds / (args.environments * args.duration)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+fire thousands of concurrent /api/claim requests at the api (fake docker
+backend) and check that no environment is ever handed to two claims
+
+    python bench/claim_stress.py --environments 50 --claims 5000 --concurrency 200
+
+exits non-zero if more claims were granted than there are environments,
+a claim token was issued twice, or the registry's counts disagree
+"""
+
+import argparse
+import sys
+from harness import Server, post, report, run_concurrently
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--environments', type=int, default=50)
+    parser.add_argument('--claims', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--port', type=int, default=18080)
+    args = parser.parse_args()
+
+    server = Server(args.environments, args.port).start()
+    try:
+        url = server.url('/api/claim')
+        results, elapsed = run_concurrently(lambda i: post(url, {}), range(0, args.claims), args.concurrency)
+        report('claim', [seconds for seconds, response in results], elapsed)
+        tokens = [response['claimToken'] for seconds, response in results if response['claimGranted']]
+        tickets = [response['claimTicket'] for seconds, response in results if not response['claimGranted']]
+        claimed = server.metric('minienv_environments{status="claimed"}')
+        queued = server.metric('minienv_claim_queue_length')
+    finally:
+        server.stop()
+
+    print('granted={} unique tokens={} claimed environments={} queued={}'.format(
+        len(tokens), len(set(tokens)), int(claimed), int(queued)))
+    failures = []
+    if len(tokens) != args.environments:
+        failures.append('expected {} granted claims, got {}'.format(args.environments, len(tokens)))
+    if len(set(tokens)) != len(tokens):
+        failures.append('claim tokens issued more than once')
+    if claimed != len(tokens):
+        failures.append('{} claims granted but {} environments claimed'.format(len(tokens), int(claimed)))
+    if queued != len(tickets):
+        failures.append('{} tickets issued but {} queued'.format(len(tickets), int(queued)))
+    for failure in failures:
+        print('FAIL: ' + failure)
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+micro-benchmark of docker_compose.get_project: the parse every call used
+to pay against the memoized lookups that replaced it
+
+    python bench/get_project_bench.py --iterations 2000
+
+no docker daemon is needed; building a project does not connect to it
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docker_compose import get_project, load_project  # noqa: E402
+from harness import percentile  # noqa: E402
+
+COMPOSE_FILE = """version: '3'
+services:
+  minienv:
+    image: 127.0.0.1:5000/minienv/minienv:latest
+    privileged: true
+    volumes:
+      - minienv-env-1-volume:/var/lib/docker
+    ports:
+      - "40000:30081"
+      - "40001:30082"
+      - "40002:30083"
+    environment:
+      - MINIENV_LOG_PORT=30081
+      - MINIENV_EDITOR_PORT=30082
+      - MINIENV_PROXY_PORT=30083
+      - MINIENV_GIT_REPO=https://github.com/minienv/example-{}
+volumes:
+  minienv-env-1-volume:
+    external: true
+"""
+
+
+def measure(name, iterations, fn):
+    timings = []
+    for i in range(0, iterations):
+        start_time = time.time()
+        fn(i)
+        timings.append(time.time() - start_time)
+    print('{:<36} mean={:8.1f}us p50={:8.1f}us p99={:8.1f}us'.format(
+        name, sum(timings) / len(timings) * 1e6, percentile(timings, 50) * 1e6, percentile(timings, 99) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='minienv-bench-')
+    file_name = 'docker-compose-minienv-env-1.yml'
+    file_path = os.path.join(work_dir, file_name)
+
+    def write(i):
+        with open(file_path, 'w') as f:
+            f.write(COMPOSE_FILE.format(i))
+
+    try:
+        write(0)
+        # what every is_env_deployed/delete_env call cost before memoization
+        measure('parse (uncached)', args.iterations,
+                lambda i: load_project(work_dir, 'minienv-env-1', file_name))
+        get_project(work_dir, 'minienv-env-1', file_name)
+        measure('get_project, unchanged file', args.iterations,
+                lambda i: get_project(work_dir, 'minienv-env-1', file_name))
+        # rewritten with the same content: mtime changes, the digest matches
+        measure('get_project, same content rewritten', args.iterations,
+                lambda i: (write(0), get_project(work_dir, 'minienv-env-1', file_name)))
+        measure('get_project, new content', args.iterations,
+                lambda i: (write(i + 1), get_project(work_dir, 'minienv-env-1', file_name)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
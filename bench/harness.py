@@ -0,0 +1,139 @@
+"""
+shared helpers for the load scripts: run the api under pywsgi against the
+in-memory docker backend and time requests against it
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATES = ('docker-compose-env.yml.template', 'docker-compose-provision.yml.template')
+
+
+class Server(object):
+    """
+    app.py in a child process with MINIENV_BACKEND=fake, working in a
+    scratch directory so the compose files it writes are thrown away
+    """
+
+    def __init__(self, environments, port=18080, latencies='', env=None):
+        self.environments = environments
+        self.port = port
+        self.latencies = latencies
+        self.env = env or {}
+        self.work_dir = None
+        self.process = None
+
+    def start(self, timeout=60):
+        self.work_dir = tempfile.mkdtemp(prefix='minienv-bench-')
+        for template in TEMPLATES:
+            shutil.copy(os.path.join(REPO_DIR, template), self.work_dir)
+        env = dict(os.environ)
+        env.update({
+            'PORT': str(self.port),
+            'MINIENV_BACKEND': 'fake',
+            'MINIENV_FAKE_LATENCIES': self.latencies,
+            'MINIENV_STATE_FILE': '',
+            'MINIENV_PROVISION_COUNT': str(self.environments),
+            'MINIENV_NODE_HOST_NAME': 'localhost'})
+        env.update(self.env)
+        log = open(os.path.join(self.work_dir, 'app.log'), 'w')
+        self.process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'app.py')], cwd=self.work_dir,
+                                        env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.wait_for_idle(self.environments, timeout)
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+        if self.work_dir is not None:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.port, path)
+
+    def metric(self, name):
+        """
+        value of one series from /api/metrics, e.g. 'minienv_environments{status="idle"}'
+        """
+        for line in urllib2.urlopen(self.url('/api/metrics'), timeout=10).read().splitlines():
+            if line.startswith(name + ' '):
+                return float(line.split(' ')[-1])
+        return None
+
+    def wait_for_idle(self, count, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise Exception('Server exited; see {}/app.log'.format(self.work_dir))
+            try:
+                if self.metric('minienv_environments{status="idle"}') >= count:
+                    return
+            except Exception:
+                pass
+            time.sleep(0.2)
+        raise Exception('Environments not provisioned after {} seconds'.format(timeout))
+
+
+def post(url, body, timeout=60):
+    """
+    (seconds taken, decoded response) for a JSON POST
+    """
+    req = urllib2.Request(url, json.dumps(body), {'Content-Type': 'application/json'})
+    start_time = time.time()
+    response = urllib2.urlopen(req, timeout=timeout).read()
+    return time.time() - start_time, json.loads(response)
+
+
+def run_concurrently(fn, items, concurrency):
+    """
+    call fn(item) for every item from concurrency threads; returns the
+    results in item order and the elapsed seconds
+    """
+    results = [None] * len(items)
+    errors = []
+    position = [0]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = position[0]
+                position[0] += 1
+            if i >= len(items):
+                return
+            try:
+                results[i] = fn(items[i])
+            except Exception as e:
+                errors.append(e)
+
+    start_time = time.time()
+    threads = [threading.Thread(target=worker) for i in range(0, concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise Exception('{} requests failed; first error: {}'.format(len(errors), errors[0]))
+    return results, time.time() - start_time
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def report(name, latencies, elapsed):
+    print('{:<24} n={:<6} p50={:8.2f}ms p99={:8.2f}ms throughput={:8.1f}/s'.format(
+        name, len(latencies), percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        len(latencies) / elapsed if elapsed > 0 else 0))
@@ -0,0 +1,63 @@
+"""
+cached container state, keyed by compose project label
+"""
+
+import threading
+import time
+from compose.cli.command import get_project_name
+from compose.const import LABEL_PROJECT
+from docker_compose import docker_call_latency
+
+
+class ContainerStateCache(object):
+    """
+    snapshot of every compose-managed container, refreshed in bulk with a
+    single container listing once it is older than max_age seconds
+    """
+
+    def __init__(self, client, max_age):
+        self.client = client
+        self.max_age = max_age
+        self._projects = {}
+        self._refreshed_at = 0
+        self._refresh_lock = threading.Lock()
+
+    def get(self, project_name):
+        """
+        ps-style items for the project's containers (empty if it has none)
+        """
+        # compose labels containers with the normalized project name
+        project_name = get_project_name(None, project_name)
+        if self.is_stale():
+            with self._refresh_lock:
+                # another caller may have refreshed while we waited for the lock
+                if self.is_stale():
+                    self.refresh()
+        return self._projects.get(project_name, [])
+
+    def is_stale(self):
+        return time.time() - self._refreshed_at > self.max_age
+
+    def refresh(self):
+        projects = {}
+        with docker_call_latency.time(call='containers'):
+            containers = self.client.containers(all=True, filters={'label': LABEL_PROJECT})
+        for container in containers:
+            labels = container.get('Labels') or {}
+            project_name = labels.get(LABEL_PROJECT)
+            names = container.get('Names') or ['']
+            projects.setdefault(project_name, []).append({
+                'id': container['Id'],
+                'name': names[0].lstrip('/'),
+                'state': container.get('State'),
+                'labels': labels,
+                'is_running': container.get('State') == 'running'})
+        # swap in the new snapshot in one assignment so readers never see a partial listing
+        self._projects = projects
+        self._refreshed_at = time.time()
+
+    def invalidate(self):
+        """
+        force the next read to refresh, e.g. after a project was brought up or down
+        """
+        self._refreshed_at = 0
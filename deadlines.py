@@ -0,0 +1,76 @@
+"""
+deadline scheduling for claim and inactivity expiry
+"""
+
+import heapq
+import threading
+import time
+
+
+class DeadlineScheduler(object):
+    """
+    min-heap of per-key deadlines served by one daemon thread that calls
+    callback(key) when a deadline passes
+
+    pushing a deadline back (the common case: every ping) only updates a dict;
+    the heap entry is re-queued at the new deadline when the old one comes up.
+    moving a deadline earlier pushes a new heap entry, so scheduling is O(1)
+    or O(log N) and nothing ever scans all keys
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._deadlines = {}
+        self._heap = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='deadlines')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def schedule(self, key, deadline):
+        with self._condition:
+            current = self._deadlines.get(key)
+            self._deadlines[key] = deadline
+            if current is None or deadline < current:
+                heapq.heappush(self._heap, (deadline, key))
+                if self._heap[0][1] == key:
+                    self._condition.notify()
+
+    def cancel(self, key):
+        with self._condition:
+            # the heap entry is dropped lazily when it comes up
+            self._deadlines.pop(key, None)
+
+    def _run(self):
+        while True:
+            key = self._next_due()
+            try:
+                self.callback(key)
+            except Exception as e:
+                print('Error handling deadline for {}: {}'.format(key, e))
+
+    def _next_due(self):
+        with self._condition:
+            while True:
+                if len(self._heap) == 0:
+                    self._condition.wait()
+                    continue
+                deadline, key = self._heap[0]
+                now = time.time()
+                if deadline > now:
+                    self._condition.wait(deadline - now)
+                    continue
+                heapq.heappop(self._heap)
+                current = self._deadlines.get(key)
+                if current is None:
+                    # cancelled
+                    continue
+                if current > deadline:
+                    # pushed back since this entry was queued
+                    heapq.heappush(self._heap, (current, key))
+                    continue
+                del self._deadlines[key]
+                return key
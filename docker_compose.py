@@ -2,15 +2,28 @@
 bridge to docker-compose
 """
 
+import hashlib
 import logging
 import os
+import threading
 from os.path import normpath
 from compose.container import Container
-from compose.cli.command import get_project as compose_get_project, get_config_path_from_options
+from compose.cli.command import get_client, get_project as compose_get_project, get_config_path_from_options, \
+    get_project_name as compose_get_project_name
+from compose.config.config import ConfigDetails, ConfigFile, load as load_config
 from compose.config.environment import Environment
+from compose.project import Project
 
 from compose.const import API_VERSIONS, COMPOSEFILE_V3_0
+from metrics import Histogram, timed
 
+docker_call_latency = Histogram('minienv_docker_call_seconds', 'Time spent in docker and compose calls, by call')
+
+# project name -> (file path, mtime, content digest, project)
+_projects = {}
+_projects_lock = threading.Lock()
+
+@timed(docker_call_latency, call='ps')
 def ps_(project):
     """
     containers status
@@ -25,7 +38,7 @@ def ps_(project):
         'state': container.human_readable_state,
         'labels': container.labels,
         'ports': container.ports,
-        'volumes': get_volumes(get_container_from_id(project.client, container.id)),
+        'volumes': get_volumes(container),
         'is_running': container.is_running} for container in running_containers]
 
     return items
@@ -43,15 +56,53 @@ def get_volumes(container):
     mounts = container.get('Mounts')
     return [dict(source=mount['Source'], destination=mount['Destination']) for mount in mounts]
 
-def get_project(path, name, file):
+@timed(docker_call_latency, call='get_project')
+def get_project(path, name, file, config=None):
     """
-    get docker project given file path
+    get docker project given file path; parsed projects are memoized until the
+    compose file's mtime and content change. pass the config dict the file was
+    just written from to build the project without re-parsing it
     """
     logging.debug('get project ' + path)
 
+    if file is None:
+        return load_project(path, name, file)
+    file_path = os.path.join(path, file)
+    mtime = os.path.getmtime(file_path)
+    with _projects_lock:
+        cached = _projects.get(name)
+    if config is None and cached is not None and cached[0] == file_path and cached[1] == mtime:
+        return cached[3]
+    with open(file_path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    if cached is not None and cached[0] == file_path and cached[2] == digest:
+        project = cached[3]
+    else:
+        project = load_project(path, name, file, config)
+    with _projects_lock:
+        _projects[name] = (file_path, mtime, digest, project)
+    return project
+
+def invalidate_project(name):
+    """
+    drop the memoized project, e.g. after its compose file was rewritten or removed
+    """
+    with _projects_lock:
+        _projects.pop(name, None)
+
+def load_project(path, name, file, config=None):
+    """
+    parse the docker project given file path, or build it from an already loaded config dict
+    """
     environment = Environment.from_env_file(path)
     if file is not None:
         environment['COMPOSE_FILE'] = file
+    if config is not None:
+        config_details = ConfigDetails(os.path.abspath(path), [ConfigFile(file, config)], environment)
+        config_data = load_config(config_details)
+        api_version = environment.get('COMPOSE_API_VERSION', API_VERSIONS[config_data.version])
+        client = get_client(environment, version=api_version)
+        return Project.from_config(compose_get_project_name(path, name, environment), config_data, client)
     config_path = get_config_path_from_options(path, dict(), environment)
     project = compose_get_project(path, config_path, project_name=name)
     return project
@@ -0,0 +1,53 @@
+"""
+docker events stream for compose-managed containers
+"""
+
+import threading
+import time
+from compose.const import LABEL_PROJECT
+
+WATCHED_ACTIONS = ['start', 'die', 'destroy']
+
+
+class EventWatcher(object):
+    """
+    daemon thread that calls handler(project_label, action) for every
+    start/die/destroy of a container carrying the compose project label;
+    reconnects with a growing delay if the stream drops
+    """
+
+    def __init__(self, client, handler, max_retry_seconds=30):
+        self.client = client
+        self.handler = handler
+        self.max_retry_seconds = max_retry_seconds
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='docker-events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        retry_seconds = 1
+        while True:
+            try:
+                filters = {'type': 'container', 'label': LABEL_PROJECT, 'event': WATCHED_ACTIONS}
+                for event in self.client.events(decode=True, filters=filters):
+                    retry_seconds = 1
+                    self._dispatch(event)
+            except Exception as e:
+                print('Docker events stream failed: {}'.format(e))
+            time.sleep(retry_seconds)
+            retry_seconds = min(retry_seconds * 2, self.max_retry_seconds)
+
+    def _dispatch(self, event):
+        actor = event.get('Actor') or {}
+        attributes = actor.get('Attributes') or {}
+        project_label = attributes.get(LABEL_PROJECT)
+        action = event.get('Action') or event.get('status')
+        if project_label is None or action not in WATCHED_ACTIONS:
+            return
+        try:
+            self.handler(project_label, action)
+        except Exception as e:
+            print('Error handling docker event {} for {}: {}'.format(action, project_label, e))
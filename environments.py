@@ -0,0 +1,400 @@
+"""
+environment registry
+"""
+
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+STATUS_IDLE = 0
+STATUS_PROVISIONING = 1
+STATUS_CLAIMED = 2
+STATUS_RUNNING = 3
+STATUS_UPDATING = 4
+
+STATUSES = (STATUS_IDLE, STATUS_PROVISIONING, STATUS_CLAIMED, STATUS_RUNNING, STATUS_UPDATING)
+STATUS_NAMES = {
+    STATUS_IDLE: 'idle',
+    STATUS_PROVISIONING: 'provisioning',
+    STATUS_CLAIMED: 'claimed',
+    STATUS_RUNNING: 'running',
+    STATUS_UPDATING: 'updating'
+}
+
+
+class Environment(object):
+    """
+    per-environment record; status and claim_token must only be changed
+    through the registry so its indexes stay in sync
+    """
+    __slots__ = ('id', 'index', 'status', 'claim_token', 'last_activity', 'repo', 'details', 'up_request',
+                 'provision_job', 'up_job', 'warm_details', 'node', 'slot', 'images', 'provision_failures',
+                 'version')
+
+    def __init__(self, env_id, index, status=STATUS_IDLE):
+        self.id = env_id
+        self.index = index
+        self.status = status
+        self.claim_token = ''
+        self.last_activity = 0
+        self.repo = None
+        self.details = None
+        self.up_request = None
+        self.provision_job = None
+        self.up_job = None
+        # details of the last deployment, kept while the environment sits idle
+        # with that repo still deployed so a later claim for it can reuse it
+        self.warm_details = None
+        # swarm node the environment is placed on, and its port block there
+        self.node = None
+        self.slot = None
+        # images loaded into the environment's volume by its last provisioning
+        self.images = None
+        # provisioner runs in a row that exited with an error
+        self.provision_failures = 0
+        # bumped on every change the registry announces to its listeners
+        self.version = 0
+
+
+class ClaimTicket(object):
+    """
+    place in the claim queue; claim_token is reserved up front and becomes
+    valid once an environment is handed over
+    """
+    __slots__ = ('ticket', 'claim_token', 'seq', 'last_activity', 'environment')
+
+    def __init__(self, ticket, claim_token, seq, now):
+        self.ticket = ticket
+        self.claim_token = claim_token
+        self.seq = seq
+        self.last_activity = now
+        self.environment = None
+
+
+class EnvironmentRegistry(object):
+    """
+    environments indexed by id, claim token and status
+
+    the idle bucket is kept in insertion order so it doubles as the free-list
+    claims are served from. every mutation happens under one lock so request
+    handlers and the checker thread see atomic transitions. the app does not
+    monkey-patch, so request greenlets and worker threads share a real OS
+    lock; the critical sections never block or do I/O, so a greenlet only
+    ever waits for one short section held by another thread
+    """
+
+    def __init__(self, ticket_timeout=None):
+        self._lock = threading.RLock()
+        self._by_id = OrderedDict()
+        self._by_claim_token = {}
+        self._by_status = dict((status, OrderedDict()) for status in STATUSES)
+        # idle environments that last ran a repo, keyed by that repo
+        self._idle_by_repo = {}
+        # indexes (and therefore port blocks) are handed out lowest-first and
+        # recycled when an environment is removed
+        self._next_index = 0
+        self._free_indexes = []
+        # FIFO of ClaimTickets waiting for an environment; environments that
+        # become idle are handed straight to the head of the queue
+        self._waiters = OrderedDict()
+        self._granted = {}
+        # queued tickets not polled for this many seconds are dropped instead
+        # of being handed an environment nobody will pick up
+        self.ticket_timeout = ticket_timeout
+        self._next_seq = 0
+        self._last_hand_off = None
+        self._hand_off_interval = None
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """
+        listener(environment) is called, under the registry lock, after every
+        change to an environment's status or claim; it must not block
+        """
+        self._listeners.append(listener)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._by_id.values()))
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def create(self, status):
+        """
+        allocate the lowest free index and register a new environment for it
+        """
+        with self._lock:
+            if len(self._free_indexes) > 0:
+                index = heapq.heappop(self._free_indexes)
+            else:
+                index = self._next_index
+                self._next_index += 1
+            environment = Environment(str(index + 1), index, status)
+            self.add(environment)
+            self._notify(environment)
+            return environment
+
+    def remove(self, environment, from_status, free_index=True):
+        """
+        unregister the environment if it is still in from_status and free its
+        index; with free_index=False the index stays reserved until
+        free_index() is called, for when the environment's resources (named
+        after its id) are still being torn down
+        """
+        with self._lock:
+            if not self._matches(environment, from_status, None):
+                return False
+            self._by_id.pop(environment.id, None)
+            self._by_status[environment.status].pop(environment.id, None)
+            self._unindex_repo(environment)
+            self._set_claim_token(environment, '')
+            if free_index:
+                heapq.heappush(self._free_indexes, environment.index)
+            self._notify(environment)
+            return True
+
+    def free_index(self, index):
+        """
+        return the index of a removed environment to create()
+        """
+        with self._lock:
+            if index < self._next_index and index not in self._free_indexes:
+                heapq.heappush(self._free_indexes, index)
+
+    def add(self, environment):
+        with self._lock:
+            if environment.index in self._free_indexes:
+                self._free_indexes.remove(environment.index)
+                heapq.heapify(self._free_indexes)
+            # indexes skipped over stay available to create()
+            for index in range(self._next_index, environment.index):
+                heapq.heappush(self._free_indexes, index)
+            self._next_index = max(self._next_index, environment.index + 1)
+            self._by_id[environment.id] = environment
+            self._by_status[environment.status][environment.id] = environment
+            if environment.claim_token:
+                self._by_claim_token[environment.claim_token] = environment
+
+    def restore(self, environment):
+        """
+        register an environment recovered from a previous run, keeping its
+        index, status and claim
+        """
+        with self._lock:
+            self.add(environment)
+            if environment.status == STATUS_IDLE and environment.repo:
+                self._idle_by_repo.setdefault(environment.repo, OrderedDict())[environment.id] = environment
+            self._notify(environment)
+
+    def get(self, env_id):
+        return self._by_id.get(env_id)
+
+    def find_by_claim_token(self, claim_token):
+        if not claim_token:
+            return None
+        return self._by_claim_token.get(claim_token)
+
+    def touch(self, claim_token, now):
+        """
+        record activity for a claim; returns None if the claim is no longer valid
+        """
+        with self._lock:
+            environment = self.find_by_claim_token(claim_token)
+            if environment is not None:
+                environment.last_activity = now
+            return environment
+
+    def with_status(self, status):
+        with self._lock:
+            return list(self._by_status[status].values())
+
+    def count(self, status):
+        return len(self._by_status[status])
+
+    def claim(self, claim_token, now, repo=None):
+        """
+        take the next idle environment off the free-list and mark it claimed,
+        preferring one that last ran repo
+        """
+        with self._lock:
+            idle = self._idle_by_repo.get(repo) if repo else None
+            if not idle:
+                idle = self._by_status[STATUS_IDLE]
+            if len(idle) == 0:
+                return None
+            environment = next(iter(idle.values()))
+            self._set_status(environment, STATUS_CLAIMED)
+            self._set_claim_token(environment, claim_token)
+            environment.last_activity = now
+            self._notify(environment)
+            return environment
+
+    def enqueue(self, ticket, claim_token, now):
+        """
+        join the claim queue
+        """
+        with self._lock:
+            waiter = ClaimTicket(ticket, claim_token, self._next_seq, now)
+            self._next_seq += 1
+            self._waiters[ticket] = waiter
+            return waiter
+
+    def find_ticket(self, ticket, now):
+        """
+        look up (and record activity for) a queued or granted ticket; a granted
+        ticket keeps being reported until its owner stops polling and it expires,
+        so a lost response does not lose the claim
+        """
+        with self._lock:
+            waiter = self._waiters.get(ticket)
+            if waiter is None:
+                waiter = self._granted.get(ticket)
+            if waiter is not None:
+                waiter.last_activity = now
+            return waiter
+
+    def queue_position(self, waiter):
+        """
+        1-based position in the queue (an upper bound if tickets ahead expired)
+        """
+        with self._lock:
+            if len(self._waiters) == 0 or waiter.ticket not in self._waiters:
+                return 0
+            head = next(iter(self._waiters.values()))
+            return waiter.seq - head.seq + 1
+
+    def queue_length(self):
+        return len(self._waiters)
+
+    def estimated_wait(self, waiter):
+        """
+        seconds until the ticket is served, from the average interval between hand-offs
+        """
+        if self._hand_off_interval is None:
+            return None
+        return self.queue_position(waiter) * self._hand_off_interval
+
+    def expire_waiters(self, cutoff):
+        """
+        drop tickets whose owners stopped polling before cutoff
+        """
+        with self._lock:
+            for ticket, waiter in list(self._waiters.items()):
+                if waiter.last_activity < cutoff:
+                    del self._waiters[ticket]
+            for ticket, waiter in list(self._granted.items()):
+                if waiter.last_activity < cutoff:
+                    del self._granted[ticket]
+
+    def set_status(self, environment, status):
+        with self._lock:
+            self._set_status(environment, status)
+            self._notify(environment)
+
+    def transition(self, environment, from_status, to_status, claim_token=None, **fields):
+        """
+        compare-and-set: move the environment to to_status (and assign fields)
+        only if it is still in from_status (a status or tuple of statuses) and,
+        when given, still holds claim_token
+        """
+        with self._lock:
+            if not self._matches(environment, from_status, claim_token):
+                return False
+            for name, value in fields.items():
+                setattr(environment, name, value)
+            self._set_status(environment, to_status)
+            self._notify(environment)
+            return True
+
+    def release(self, environment, from_status=None, claim_token=None, last_activity=None, **fields):
+        """
+        drop the claim and return the environment to the idle free-list; the
+        optional arguments make this a compare-and-set against a snapshot the
+        caller took before deciding to release
+        """
+        with self._lock:
+            if from_status is not None and not self._matches(environment, from_status, claim_token):
+                return False
+            if last_activity is not None and environment.last_activity != last_activity:
+                return False
+            self._set_claim_token(environment, '')
+            environment.last_activity = 0
+            environment.up_request = None
+            environment.up_job = None
+            if environment.details is not None:
+                environment.warm_details = environment.details
+            environment.details = None
+            for name, value in fields.items():
+                setattr(environment, name, value)
+            self._set_status(environment, STATUS_IDLE)
+            self._notify(environment)
+            return True
+
+    def _notify(self, environment):
+        environment.version += 1
+        for listener in self._listeners:
+            listener(environment)
+
+    def _matches(self, environment, from_status, claim_token):
+        if isinstance(from_status, tuple):
+            if environment.status not in from_status:
+                return False
+        elif environment.status != from_status:
+            return False
+        return claim_token is None or environment.claim_token == claim_token
+
+    def _set_status(self, environment, status):
+        if environment.status == status:
+            return
+        if environment.status == STATUS_IDLE:
+            self._unindex_repo(environment)
+        self._by_status[environment.status].pop(environment.id, None)
+        environment.status = status
+        self._by_status[status][environment.id] = environment
+        if status == STATUS_IDLE:
+            if environment.repo:
+                self._idle_by_repo.setdefault(environment.repo, OrderedDict())[environment.id] = environment
+            if len(self._waiters) > 0:
+                self._hand_off(environment)
+
+    def _unindex_repo(self, environment):
+        idle = self._idle_by_repo.get(environment.repo)
+        if idle is not None:
+            idle.pop(environment.id, None)
+            if len(idle) == 0:
+                del self._idle_by_repo[environment.repo]
+
+    def _hand_off(self, environment):
+        hand_off_time = time.time()
+        waiter = self._next_waiter(hand_off_time)
+        if waiter is None:
+            return
+        self._set_status(environment, STATUS_CLAIMED)
+        self._set_claim_token(environment, waiter.claim_token)
+        environment.last_activity = hand_off_time
+        waiter.environment = environment
+        self._granted[waiter.ticket] = waiter
+        # exponentially weighted average of the time between hand-offs
+        if self._last_hand_off is not None:
+            interval = hand_off_time - self._last_hand_off
+            if self._hand_off_interval is None:
+                self._hand_off_interval = interval
+            else:
+                self._hand_off_interval = 0.8 * self._hand_off_interval + 0.2 * interval
+        self._last_hand_off = hand_off_time
+
+    def _next_waiter(self, now):
+        while len(self._waiters) > 0:
+            waiter = self._waiters.popitem(last=False)[1]
+            if self.ticket_timeout is None or waiter.last_activity >= now - self.ticket_timeout:
+                return waiter
+        return None
+
+    def _set_claim_token(self, environment, claim_token):
+        if environment.claim_token:
+            self._by_claim_token.pop(environment.claim_token, None)
+        environment.claim_token = claim_token
+        if claim_token:
+            self._by_claim_token[claim_token] = environment
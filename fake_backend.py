@@ -0,0 +1,247 @@
+"""
+in-memory stand-in for the docker daemon and docker-compose
+
+nothing is run: projects, containers and volumes only exist in this process
+and every call sleeps for its configured latency. services that publish no
+ports behave like the provisioner and exit after the 'job' latency. repo
+files are served locally too, so an up never leaves the machine
+"""
+
+import os
+import threading
+import time
+import uuid
+import yaml
+from Queue import Queue
+from compose.cli.command import get_project_name
+from compose.const import LABEL_PROJECT
+from docker.errors import NotFound
+
+LATENCY_NAMES = ('up', 'down', 'ps', 'containers', 'job', 'fetch')
+
+# what every repo contains unless a directory of repo files is given
+DEFAULT_REPO_FILES = {
+    'docker-compose.yml': """version: '2'
+services:
+  web:
+    image: nginx:alpine
+    ports:
+      - "80:80"
+"""
+}
+
+
+def parse_latencies(spec):
+    """
+    seconds per call from a comma-separated list of name=seconds, e.g. up=2,job=10;
+    unlisted calls take no time
+    """
+    latencies = dict((name, 0.0) for name in LATENCY_NAMES)
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        name, seconds = item.split('=', 1)
+        if name.strip() not in latencies:
+            raise ValueError('Unknown fake latency \'{}\''.format(name.strip()))
+        latencies[name.strip()] = float(seconds)
+    return latencies
+
+
+class FakeDocker(object):
+    """
+    fake docker client; it is its own low level api, so it can also be passed
+    where docker_client.api is expected
+    """
+
+    def __init__(self, latencies):
+        self.latencies = latencies
+        self.api = self
+        self.volumes = FakeVolumes()
+        self._projects = {}
+        self._containers = {}
+        self._lock = threading.Lock()
+        self._events = []
+
+    def get_project(self, path, name, file, config=None):
+        if config is None:
+            with open(os.path.join(path, file), 'r') as f:
+                config = yaml.safe_load(f)
+        with self._lock:
+            project = self._projects.get(name)
+            if project is None:
+                project = self._projects[name] = FakeProject(self, name)
+            project.config = config
+            return project
+
+    def ps_(self, project):
+        self.sleep_for('ps')
+        return [container.ps_item() for container in project.containers(stopped=True)]
+
+    def invalidate_project(self, name):
+        pass
+
+    def containers(self, all=False, filters=None):
+        self.sleep_for('containers')
+        with self._lock:
+            containers = list(self._containers.values())
+        return [container.api_item() for container in containers if all or container.is_running]
+
+    def wait(self, container_id, timeout=None):
+        container = self._containers.get(container_id)
+        if container is not None and not container.stopped.wait(timeout):
+            raise Exception('Timed out waiting for container {}'.format(container_id))
+        return {'StatusCode': 0}
+
+    def events(self, decode=False, filters=None):
+        queue = Queue()
+        with self._lock:
+            self._events.append(queue)
+        while True:
+            yield queue.get()
+
+    def add_container(self, container):
+        with self._lock:
+            self._containers[container.id] = container
+        self.emit(container, 'start')
+
+    def remove_container(self, container):
+        with self._lock:
+            self._containers.pop(container.id, None)
+        container.stop(self)
+        self.emit(container, 'destroy')
+
+    def emit(self, container, action):
+        event = {'Type': 'container', 'Action': action, 'status': action,
+                 'Actor': {'ID': container.id, 'Attributes': {LABEL_PROJECT: container.project_label}}}
+        with self._lock:
+            queues = list(self._events)
+        for queue in queues:
+            queue.put(event)
+
+    def sleep_for(self, name):
+        if self.latencies[name] > 0:
+            time.sleep(self.latencies[name])
+
+
+class FakeProject(object):
+
+    def __init__(self, docker, name):
+        self.docker = docker
+        self.name = name
+        self.config = None
+        self._containers = []
+
+    def up(self, detached=True, strategy=None):
+        self.docker.sleep_for('up')
+        for container in self._containers:
+            self.docker.remove_container(container)
+        self._containers = []
+        for service_name, service in sorted(((self.config or {}).get('services') or {}).items()):
+            container = FakeContainer(self.name, service_name, service.get('ports') or [])
+            self._containers.append(container)
+            self.docker.add_container(container)
+            if len(container.ports) == 0:
+                timer = threading.Timer(self.docker.latencies['job'], container.stop, (self.docker,))
+                timer.daemon = True
+                timer.start()
+
+    def down(self, remove_image_type=None, include_volumes=False, remove_orphans=False):
+        self.docker.sleep_for('down')
+        for container in self._containers:
+            self.docker.remove_container(container)
+        self._containers = []
+
+    def containers(self, stopped=False):
+        return [container for container in self._containers if stopped or container.is_running]
+
+
+class FakeContainer(object):
+
+    def __init__(self, project_name, service_name, ports):
+        self.id = uuid.uuid4().hex
+        self.project_label = get_project_name(None, project_name)
+        self.name = '{}_{}_1'.format(self.project_label, service_name)
+        self.name_without_project = '{}_1'.format(service_name)
+        self.labels = {LABEL_PROJECT: self.project_label}
+        self.ports = {}
+        for port in ports:
+            parts = str(port).split(':')
+            self.ports['{}/tcp'.format(parts[-1])] = [{'HostIp': '0.0.0.0', 'HostPort': parts[0]}]
+        self.stopped = threading.Event()
+
+    @property
+    def is_running(self):
+        return not self.stopped.is_set()
+
+    def stop(self, docker):
+        if not self.stopped.is_set():
+            self.stopped.set()
+            docker.emit(self, 'die')
+
+    def ps_item(self):
+        return {
+            'name': self.name,
+            'name_without_project': self.name_without_project,
+            'command': '',
+            'state': 'Up' if self.is_running else 'Exit 0',
+            'labels': self.labels,
+            'ports': self.ports,
+            'volumes': [],
+            'is_running': self.is_running}
+
+    def api_item(self):
+        return {
+            'Id': self.id,
+            'Names': ['/' + self.name],
+            'State': 'running' if self.is_running else 'exited',
+            'Labels': self.labels}
+
+
+class FakeRepoFiles(object):
+    """
+    stand-in for repo_files.RepoFileCache that serves the same files for
+    every repo, from files_dir if given; each fetch takes the 'fetch' latency
+    """
+
+    def __init__(self, latencies, files_dir=None):
+        self.latencies = latencies
+        self.files_dir = files_dir
+
+    def get(self, repo, file_name):
+        if self.latencies['fetch'] > 0:
+            time.sleep(self.latencies['fetch'])
+        if self.files_dir is None:
+            return DEFAULT_REPO_FILES.get(file_name)
+        path = os.path.join(self.files_dir, file_name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r') as f:
+            return f.read()
+
+    def get_many(self, repo, file_names):
+        return dict((file_name, self.get(repo, file_name)) for file_name in file_names)
+
+
+class FakeVolumes(object):
+
+    def __init__(self):
+        self._names = set()
+
+    def get(self, name):
+        if name not in self._names:
+            raise NotFound('No such volume: {}'.format(name))
+        return FakeVolume(self, name)
+
+    def create(self, name, **kwargs):
+        self._names.add(name)
+        return FakeVolume(self, name)
+
+
+class FakeVolume(object):
+
+    def __init__(self, volumes, name):
+        self.volumes = volumes
+        self.name = name
+
+    def remove(self):
+        self.volumes._names.discard(self.name)
@@ -0,0 +1,192 @@
+"""
+prometheus-style metrics
+
+writers never take a lock: every thread updates its own shard and scrapes sum
+the shards. the number of series is fixed by the label values used in code
+and histograms have a fixed set of buckets, so memory stays bounded
+"""
+
+import functools
+import thread
+import time
+from bisect import bisect_left
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds; tuned for request handlers and docker daemon round-trips
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_metrics = []
+
+
+class _Shards(object):
+    """
+    one dict of series per thread
+    """
+
+    def __init__(self):
+        self._shards = {}
+
+    def local(self):
+        ident = thread.get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            # setdefault is atomic, so a racing scrape sees either no shard or this one
+            shard = self._shards.setdefault(ident, {})
+        return shard
+
+    def items(self):
+        for shard in self._shards.values():
+            for key, value in shard.items():
+                yield key, value
+
+
+class Counter(object):
+    """
+    monotonically increasing counter, optionally split by label values
+    """
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._shards = _Shards()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        shard = self._shards.local()
+        key = tuple(sorted(labels.items()))
+        cell = shard.get(key)
+        if cell is None:
+            cell = shard.setdefault(key, [0])
+        cell[0] += amount
+
+    def value(self, **labels):
+        return self._values().get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} counter'.format(self.name)]
+        for key, value in sorted(self._values().items()):
+            lines.append('{}{} {}'.format(self.name, format_labels(key), value))
+        return lines
+
+    def _values(self):
+        values = {}
+        for key, cell in self._shards.items():
+            values[key] = values.get(key, 0) + cell[0]
+        return values
+
+
+class Histogram(object):
+    """
+    distribution of observed values over fixed buckets, optionally split by label values
+    """
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._shards = _Shards()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        shard = self._shards.local()
+        key = tuple(sorted(labels.items()))
+        cell = shard.get(key)
+        if cell is None:
+            # one count per bucket, one for +Inf, then the running sum
+            cell = shard.setdefault(key, [0] * (len(self.buckets) + 2))
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} histogram'.format(self.name)]
+        totals = {}
+        for key, cell in self._shards.items():
+            total = totals.get(key)
+            if total is None:
+                total = totals[key] = [0] * len(cell)
+            for i, value in enumerate(cell):
+                total[i] += value
+        for key, total in sorted(totals.items()):
+            cumulative = 0
+            for i, bound in enumerate(self.buckets + ('+Inf',)):
+                cumulative += total[i]
+                bucket_key = key + (('le', bound),)
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(bucket_key), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(key), total[-1]))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(key), cumulative))
+        return lines
+
+
+class Gauge(object):
+    """
+    point-in-time value; either set explicitly or computed at scrape time by
+    fn, which returns (labels dict, value) pairs
+    """
+
+    def __init__(self, name, help_text, fn=None):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        self._values = {}
+        _metrics.append(self)
+
+    def set(self, value, **labels):
+        self._values[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} gauge'.format(self.name)]
+        values = dict(self._values)
+        if self.fn is not None:
+            for labels, value in self.fn():
+                values[tuple(sorted(labels.items()))] = value
+        for key, value in sorted(values.items()):
+            lines.append('{}{} {}'.format(self.name, format_labels(key), value))
+        return lines
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+        return False
+
+
+def timed(histogram, **labels):
+    """
+    decorator recording the call duration of the wrapped function
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_labels(key):
+    if len(key) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in key) + '}'
+
+
+def render():
+    """
+    all registered metrics in the prometheus text exposition format
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,89 @@
+"""
+parsed minienv.json, and the proxy tabs it defines for a repo's compose services
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class MinienvConfig(object):
+    """
+    minienv.json with the proxy settings indexed by port
+    """
+
+    def __init__(self, minienv_dict=None):
+        minienv_dict = minienv_dict or {}
+        editor = minienv_dict.get('editor') or {}
+        self.editor_hidden = bool(editor.get('hide'))
+        self.editor_src_dir = editor.get('srcDir') or ''
+        # port -> proxy settings; the first entry for a port wins
+        self.proxy_ports = {}
+        for proxy_port in (minienv_dict.get('proxy') or {}).get('ports') or []:
+            if proxy_port.get('port') is not None:
+                self.proxy_ports.setdefault(int(proxy_port['port']), proxy_port)
+
+
+def get_published_ports(port):
+    """
+    host ports a compose port entry publishes, in any of the short forms
+    (3000, "3000-3005", "8000:80", "127.0.0.1::80", "6060:6060/udp", ...)
+    or the long form dict; entries without a host port give the container port
+    """
+    if isinstance(port, dict):
+        published = port.get('published', port.get('target'))
+        return [] if published is None else get_published_ports(str(published))
+    parts = str(port).split('/')[0].split(':')
+    # [ip:][host:]container
+    host = parts[-2] if len(parts) > 1 else ''
+    ports = host if len(host) > 0 else parts[-1]
+    if '-' in ports:
+        start, end = ports.split('-', 1)
+        return list(range(int(start), int(end) + 1))
+    return [int(ports)]
+
+
+def get_tabs(docker_compose_dict, config):
+    """
+    one tab per published service port (named after the port unless
+    minienv.json says otherwise), minus the hidden ones
+    """
+    tabs = []
+    services = (docker_compose_dict or {}).get('services') or {}
+    for name in sorted(services.keys()):
+        for port in (services[name] or {}).get('ports') or []:
+            for tab_port in get_published_ports(port):
+                proxy_port = config.proxy_ports.get(tab_port, {})
+                if proxy_port.get('hide'):
+                    continue
+                proxy_tabs = proxy_port.get('tabs') or [proxy_port]
+                for proxy_tab in proxy_tabs:
+                    tabs.append({
+                        'port': tab_port,
+                        'name': proxy_tab.get('name', str(tab_port)),
+                        'path': proxy_tab.get('path', proxy_port.get('path', ''))})
+    return tabs
+
+
+class TabCache(object):
+    """
+    LRU of computed tabs, keyed by whatever identifies their inputs
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self._lock:
+            tabs = self._entries.pop(key, None)
+            if tabs is not None:
+                self._entries[key] = tabs
+        if tabs is None:
+            tabs = compute()
+            with self._lock:
+                self._entries[key] = tabs
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        # callers get their own copies to put in envDetails
+        return [dict(tab) for tab in tabs]
@@ -0,0 +1,118 @@
+"""
+placement of environments on swarm nodes
+"""
+
+import heapq
+import threading
+from collections import OrderedDict
+
+
+class Node(object):
+    """
+    a swarm node; environments on it get port blocks (slots) from
+    0 to capacity - 1, independent of the other nodes
+    """
+
+    def __init__(self, name, host, capacity):
+        self.name = name
+        self.host = host
+        self.capacity = capacity
+        self.env_ids = set()
+        self._free_slots = list(range(0, capacity))
+
+    def free(self):
+        return len(self._free_slots)
+
+    def is_free(self, slot):
+        return slot in self._free_slots
+
+    def take_slot(self, slot=None):
+        if slot is None:
+            return heapq.heappop(self._free_slots)
+        self._free_slots.remove(slot)
+        heapq.heapify(self._free_slots)
+        return slot
+
+    def give_slot(self, slot):
+        heapq.heappush(self._free_slots, slot)
+
+
+class PlacementScheduler(object):
+    """
+    assigns each environment a node and a port slot on it
+
+    new environments go to the node with the largest share of free slots,
+    and between equally free nodes to the one with the fewest active
+    environments, so load spreads evenly even when capacities differ
+    """
+
+    def __init__(self, nodes):
+        # configured order, so ties go to the node listed first
+        self.nodes = OrderedDict((node.name, node) for node in nodes)
+        self._placements = {}
+        self._lock = threading.Lock()
+
+    def place(self, env_id, loads=None):
+        """
+        (node, slot) for a new environment, or None if every node is full;
+        loads maps node name to its number of active environments
+        """
+        loads = loads or {}
+        with self._lock:
+            candidates = [node for node in self.nodes.values() if node.free() > 0]
+            if len(candidates) == 0:
+                return None
+            node = max(candidates, key=lambda n: (float(n.free()) / n.capacity, -loads.get(n.name, 0)))
+            return self._assign(env_id, node, node.take_slot())
+
+    def restore(self, env_id, node_name, slot):
+        """
+        re-take a placement recorded by a previous run; returns None if the
+        node is gone or the slot is no longer valid on it
+        """
+        with self._lock:
+            node = self.nodes.get(node_name)
+            if node is None or slot is None or not node.is_free(slot):
+                return None
+            return self._assign(env_id, node, node.take_slot(slot))
+
+    def release(self, env_id):
+        with self._lock:
+            placement = self._placements.pop(env_id, None)
+            if placement is not None:
+                node, slot = placement
+                node.env_ids.discard(env_id)
+                node.give_slot(slot)
+
+    def node_for(self, env_id):
+        placement = self._placements.get(env_id)
+        return placement[0] if placement is not None else None
+
+    def capacity(self):
+        return sum(node.capacity for node in self.nodes.values())
+
+    def _assign(self, env_id, node, slot):
+        node.env_ids.add(env_id)
+        self._placements[env_id] = (node, slot)
+        return node, slot
+
+
+def parse_nodes(spec, default_host, default_capacity):
+    """
+    nodes from a comma-separated list of name[:host[:capacity]]; the host
+    defaults to the node name. an empty spec is the single local node
+    """
+    nodes = []
+    for item in spec.split(','):
+        item = item.strip()
+        if len(item) == 0:
+            continue
+        parts = item.split(':')
+        name = parts[0]
+        host = parts[1] if len(parts) > 1 and len(parts[1]) > 0 else name
+        capacity = int(parts[2]) if len(parts) > 2 else default_capacity
+        nodes.append(Node(name, host, capacity))
+    if len(nodes) == 0:
+        # classic swarm reads '*' as "any node"; a plain engine ignores the constraint
+        nodes.append(Node('*', default_host, default_capacity))
+    return nodes
@@ -0,0 +1,67 @@
+"""
+demand tracking for the images pre-loaded into idle environments
+"""
+
+import threading
+
+
+def get_compose_images(docker_compose_dict):
+    """
+    images referenced by the services of a parsed compose file; services that
+    are built, or whose image needs compose interpolation, are skipped
+    """
+    images = []
+    services = (docker_compose_dict or {}).get('services') or {}
+    for service in services.values():
+        image = service.get('image') if isinstance(service, dict) else None
+        if image and '$' not in image and image not in images:
+            images.append(image)
+    return images
+
+
+class ImageDemand(object):
+    """
+    how often each image was asked for by an up request
+
+    counts are halved once the total passes max_total, so demand from long
+    ago fades out and images nobody asks for anymore drop to zero and are
+    forgotten
+    """
+
+    def __init__(self, max_total=10000):
+        self.max_total = max_total
+        self._counts = {}
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def record(self, images):
+        with self._lock:
+            for image in images:
+                self._counts[image] = self._counts.get(image, 0) + 1
+                self._total += 1
+            if self._total > self.max_total:
+                self._decay()
+
+    def top(self, count):
+        """
+        the count most requested images, most requested first
+        """
+        with self._lock:
+            ranked = sorted(self._counts.items(), key=lambda item: (-item[1], item[0]))
+        return [image for image, n in ranked[:count]]
+
+    def _decay(self):
+        for image in list(self._counts.keys()):
+            self._counts[image] //= 2
+            if self._counts[image] == 0:
+                del self._counts[image]
+        self._total = sum(self._counts.values())
+
+
+def get_coverage(images, wanted):
+    """
+    share of the wanted images already loaded (1.0 if nothing is wanted)
+    """
+    if len(wanted) == 0:
+        return 1.0
+    return float(len(set(images or []).intersection(wanted))) / len(wanted)
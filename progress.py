@@ -0,0 +1,95 @@
+"""
+fan-out of deployment progress to streaming clients
+"""
+
+import itertools
+import threading
+from collections import deque
+
+
+class Subscription(object):
+    """
+    one client's bounded buffer of events; when the client falls behind the
+    oldest events are dropped, so a slow reader costs at most max_events.
+    on_event() is called after every push and must not block
+    """
+
+    def __init__(self, hub, key, max_events, on_event=None):
+        self.hub = hub
+        self.key = key
+        self.dropped = 0
+        self._events = deque(maxlen=max_events)
+        self._on_event = on_event
+
+    def push(self, event):
+        if len(self._events) == self._events.maxlen:
+            self.dropped += 1
+        self._events.append(event)
+        self.wake()
+
+    def wake(self):
+        if self._on_event is not None:
+            self._on_event()
+
+    def drain(self):
+        events = []
+        while len(self._events) > 0:
+            events.append(self._events.popleft())
+        return events
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class ProgressHub(object):
+    """
+    progress events per key (a claim token)
+
+    publishers are worker threads and never wait on a subscriber: events
+    are appended to each subscriber's deque and its on_event callback wakes
+    the stream handler that drains it. a new subscriber first gets the
+    latest event for its key so it knows where a deployment already is
+    """
+
+    def __init__(self, max_events=64):
+        self.max_events = max(1, max_events)
+        self._subscriptions = {}
+        self._latest = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def publish(self, key, name, data):
+        with self._lock:
+            event = (next(self._ids), name, data)
+            self._latest[key] = event
+            subscriptions = list(self._subscriptions.get(key, ()))
+        for subscription in subscriptions:
+            subscription.push(event)
+
+    def subscribe(self, key, on_event=None):
+        subscription = Subscription(self, key, self.max_events, on_event)
+        with self._lock:
+            self._subscriptions.setdefault(key, set()).add(subscription)
+            latest = self._latest.get(key)
+        if latest is not None:
+            subscription.push(latest)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.key)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if len(subscriptions) == 0:
+                    del self._subscriptions[subscription.key]
+
+    def forget(self, key):
+        """
+        drop the latest event for key once its claim has ended, and wake its
+        subscribers so they notice
+        """
+        with self._lock:
+            self._latest.pop(key, None)
+            subscriptions = list(self._subscriptions.get(key, ()))
+        for subscription in subscriptions:
+            subscription.wake()
@@ -0,0 +1,104 @@
+"""
+cached downloads of repo metadata files (minienv.json, docker-compose.yml, ...)
+"""
+
+import threading
+import time
+import urllib2
+from collections import OrderedDict
+from metrics import Histogram
+
+fetch_latency = Histogram('minienv_repo_fetch_seconds', 'Time spent downloading repo files, by file and outcome')
+
+
+class RepoFileCache(object):
+    """
+    LRU cache of raw repo files keyed by (repo, file name)
+
+    entries are served from memory for ttl seconds and then revalidated with
+    If-None-Match/If-Modified-Since. files the repo does not have are cached
+    as None for negative_ttl seconds
+    """
+
+    def __init__(self, ttl, negative_ttl, max_entries, timeout=30):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max(1, max_entries)
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, repo, file_name):
+        """
+        file content, or None if the repo does not have the file
+        """
+        key = (repo, file_name)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # re-insert to mark as most recently used
+                self._entries[key] = entry
+        if entry is not None and entry['expires'] > time.time():
+            return entry['content']
+        entry = self._fetch(repo, file_name, entry)
+        if entry is None:
+            return None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry['content']
+
+    def get_many(self, repo, file_names):
+        """
+        fetch several files of the same repo concurrently; returns a dict of file name -> content
+        """
+        results = {}
+
+        def fetch(file_name):
+            results[file_name] = self.get(repo, file_name)
+
+        threads = []
+        for file_name in file_names:
+            thread = threading.Thread(target=fetch, args=(file_name,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _fetch(self, repo, file_name, entry):
+        url = '{}/raw/master/{}'.format(repo, file_name)
+        req = urllib2.Request(url)
+        if entry is not None and entry['content'] is not None:
+            if entry['etag'] is not None:
+                req.add_header('If-None-Match', entry['etag'])
+            if entry['last_modified'] is not None:
+                req.add_header('If-Modified-Since', entry['last_modified'])
+        start_time = time.time()
+        try:
+            response = urllib2.urlopen(req, timeout=self.timeout)
+            content = response.read()
+            fetch_latency.observe(time.time() - start_time, file=file_name, result='200')
+            return {
+                'content': content,
+                'etag': response.info().getheader('ETag'),
+                'last_modified': response.info().getheader('Last-Modified'),
+                'expires': time.time() + self.ttl
+            }
+        except urllib2.HTTPError as e:
+            fetch_latency.observe(time.time() - start_time, file=file_name, result=str(e.code))
+            if e.code == 304 and entry is not None:
+                entry['expires'] = time.time() + self.ttl
+                return entry
+            if e.code == 404:
+                return {'content': None, 'etag': None, 'last_modified': None,
+                        'expires': time.time() + self.negative_ttl}
+            print('Error downloading {}: {}'.format(file_name, e))
+        except Exception as e:
+            fetch_latency.observe(time.time() - start_time, file=file_name, result='error')
+            print('Error downloading {}: {}'.format(file_name, e))
+        # transient failure; fall back to whatever we had, but don't cache the failure
+        return entry
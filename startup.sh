@@ -1,3 +1,4 @@
 #!/bin/sh
 source venv/bin/activate
-python app.py
+# exec so SIGTERM from docker stop reaches python, not the shell
+exec python app.py
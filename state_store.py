@@ -0,0 +1,129 @@
+"""
+persistent environment state, so a restarted api can recover its registry
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# environment fields that survive a restart; jobs and other in-process state do not
+FIELDS = ('id', 'index', 'status', 'claim_token', 'last_activity', 'repo', 'details', 'up_request',
+          'warm_details', 'node', 'slot', 'images')
+JSON_FIELDS = ('details', 'up_request', 'warm_details', 'images')
+
+
+class StateStore(object):
+    """
+    sqlite-backed record of every environment, keyed by id
+
+    save and delete only queue the latest snapshot of an environment; a
+    writer thread coalesces them and commits each batch in one transaction,
+    so the registry listeners that call them never wait on the disk. any
+    object with the same load/save/delete/start/close methods can stand in
+    """
+
+    def __init__(self, path, retry_seconds=1):
+        self.path = path
+        self.retry_seconds = retry_seconds
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+    def load(self):
+        """
+        all recorded environments as dicts of FIELDS, lowest index first
+        """
+        connection = self._connect()
+        try:
+            rows = connection.execute('SELECT {} FROM environments ORDER BY idx'.format(self._columns())).fetchall()
+        finally:
+            connection.close()
+        environments = []
+        for row in rows:
+            values = dict(zip(FIELDS, row))
+            for name in JSON_FIELDS:
+                if values[name] is not None:
+                    values[name] = json.loads(values[name])
+            environments.append(values)
+        return environments
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='state-store')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, environment):
+        snapshot = tuple(getattr(environment, name) for name in FIELDS)
+        with self._condition:
+            self._pending.pop(environment.id, None)
+            self._pending[environment.id] = snapshot
+            self._condition.notify()
+
+    def delete(self, env_id):
+        with self._condition:
+            self._pending.pop(env_id, None)
+            self._pending[env_id] = None
+            self._condition.notify()
+
+    def close(self, timeout=None):
+        """
+        write out everything still queued and stop the writer
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        connection = self._connect()
+        while True:
+            with self._condition:
+                while len(self._pending) == 0 and not self._closed:
+                    self._condition.wait()
+                if len(self._pending) == 0:
+                    break
+                pending = self._pending
+                self._pending = OrderedDict()
+            try:
+                self._write(connection, pending)
+            except Exception as e:
+                print('Error writing environment state: {}'.format(e))
+                with self._condition:
+                    # keep the failed batch unless newer snapshots replaced it
+                    for env_id, snapshot in pending.items():
+                        self._pending.setdefault(env_id, snapshot)
+                    if self._closed:
+                        break
+                time.sleep(self.retry_seconds)
+        connection.close()
+
+    def _write(self, connection, pending):
+        with connection:
+            for env_id, snapshot in pending.items():
+                if snapshot is None:
+                    connection.execute('DELETE FROM environments WHERE id = ?', (env_id,))
+                    continue
+                values = dict(zip(FIELDS, snapshot))
+                for name in JSON_FIELDS:
+                    if values[name] is not None:
+                        values[name] = json.dumps(values[name])
+                connection.execute('INSERT OR REPLACE INTO environments ({}) VALUES ({})'.format(
+                    self._columns(), ', '.join('?' * len(FIELDS))), [values[name] for name in FIELDS])
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS environments ('
+                           'id TEXT PRIMARY KEY, idx INTEGER, status INTEGER, claim_token TEXT, '
+                           'last_activity REAL, repo TEXT, details TEXT, up_request TEXT, warm_details TEXT, '
+                           'node TEXT, slot INTEGER, images TEXT)')
+        return connection
+
+    def _columns(self):
+        # "index" is a keyword in sql
+        return ', '.join('idx' if name == 'index' else name for name in FIELDS)
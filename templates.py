@@ -0,0 +1,98 @@
+"""
+compose file templates
+"""
+
+import os
+import re
+import tempfile
+import yaml
+
+# $$ is compose's escape for a literal $ and ${NAME} is left for compose to interpolate
+VAR_PATTERN = re.compile(r'\$\$|\$([A-Za-z_][A-Za-z0-9_]*)')
+
+
+class TemplateError(Exception):
+    pass
+
+
+class ComposeTemplate(object):
+    """
+    compose file template with $name placeholders
+
+    the template is parsed once and every string containing placeholders is
+    pre-split into literal and variable pieces, so rendering is a single pass
+    over the tree. substitution happens on parsed values rather than raw text,
+    so bound values never need YAML escaping
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.variables = set()
+        with open(file_name, 'r') as f:
+            self._compiled = self._compile(yaml.safe_load(f))
+
+    def render(self, values):
+        """
+        config dict with every placeholder replaced; all placeholders must be bound
+        """
+        missing = self.variables.difference(values.keys())
+        if len(missing) > 0:
+            raise TemplateError('Unbound variables in {}: {}'.format(self.file_name, ', '.join(sorted(missing))))
+        # a literal $ in a value would otherwise be interpolated by compose
+        escaped = dict((name, str(value).replace('$', '$$')) for name, value in values.items())
+        return self._render(self._compiled, escaped)
+
+    def write(self, dest_file_name, values):
+        """
+        render to dest_file_name atomically and return the rendered config dict
+        """
+        config = self.render(values)
+        dest_dir = os.path.dirname(os.path.abspath(dest_file_name))
+        fd, tmp_file_name = tempfile.mkstemp(dir=dest_dir, prefix='.tmp-', suffix='.yml')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                yaml.safe_dump(config, tmp_file, default_flow_style=False)
+            os.rename(tmp_file_name, dest_file_name)
+        except:
+            os.remove(tmp_file_name)
+            raise
+        return config
+
+    def _compile(self, node):
+        if isinstance(node, dict):
+            return dict((self._compile(key), self._compile(value)) for key, value in node.items())
+        if isinstance(node, list):
+            return [self._compile(value) for value in node]
+        if isinstance(node, basestring) and '$' in node:
+            pieces = []
+            position = 0
+            for match in VAR_PATTERN.finditer(node):
+                if match.group(1) is None:
+                    continue
+                pieces.append((False, node[position:match.start()]))
+                pieces.append((True, match.group(1)))
+                self.variables.add(match.group(1))
+                position = match.end()
+            if position > 0:
+                pieces.append((False, node[position:]))
+                return _Pieces(pieces)
+        return node
+
+    def _render(self, node, values):
+        if isinstance(node, _Pieces):
+            return ''.join(values[piece] if is_var else piece for is_var, piece in node.pieces)
+        if isinstance(node, dict):
+            return dict((self._render(key, values), self._render(value, values)) for key, value in node.items())
+        if isinstance(node, list):
+            return [self._render(value, values) for value in node]
+        return node
+
+
+class _Pieces(object):
+    __slots__ = ('pieces',)
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def __hash__(self):
+        return hash(tuple(self.pieces))
@@ -0,0 +1,79 @@
+import threading
+import time
+import unittest
+from deadlines import DeadlineScheduler
+
+
+class DeadlineSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fired = []
+        self.lock = threading.Lock()
+        self.scheduler = DeadlineScheduler(self.fire)
+        self.scheduler.start()
+
+    def fire(self, key):
+        with self.lock:
+            self.fired.append((key, time.time()))
+
+    def wait_for(self, count, timeout=2):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if len(self.fired) >= count:
+                    return [key for key, fired_at in self.fired]
+            time.sleep(0.01)
+        with self.lock:
+            return [key for key, fired_at in self.fired]
+
+    def test_deadlines_fire_in_order(self):
+        now = time.time()
+        self.scheduler.schedule('c', now + 0.3)
+        self.scheduler.schedule('a', now + 0.1)
+        self.scheduler.schedule('b', now + 0.2)
+        self.assertEqual(['a', 'b', 'c'], self.wait_for(3))
+
+    def test_deadline_does_not_fire_early(self):
+        start_time = time.time()
+        self.scheduler.schedule('a', start_time + 0.2)
+        self.assertEqual(['a'], self.wait_for(1))
+        self.assertGreaterEqual(self.fired[0][1], start_time + 0.2)
+
+    def test_pushed_back_deadline_fires_once_at_the_new_time(self):
+        start_time = time.time()
+        self.scheduler.schedule('a', start_time + 0.1)
+        self.scheduler.schedule('a', start_time + 0.3)
+        self.assertEqual(['a'], self.wait_for(1))
+        self.assertGreaterEqual(self.fired[0][1], start_time + 0.3)
+        time.sleep(0.2)
+        self.assertEqual(1, len(self.fired))
+
+    def test_deadline_moved_earlier_fires_at_the_new_time(self):
+        start_time = time.time()
+        self.scheduler.schedule('a', start_time + 10)
+        self.scheduler.schedule('a', start_time + 0.1)
+        self.assertEqual(['a'], self.wait_for(1))
+        self.assertLess(self.fired[0][1], start_time + 1)
+
+    def test_cancelled_deadline_does_not_fire(self):
+        now = time.time()
+        self.scheduler.schedule('a', now + 0.1)
+        self.scheduler.schedule('b', now + 0.2)
+        self.scheduler.cancel('a')
+        self.assertEqual(['b'], self.wait_for(2, timeout=0.5))
+
+    def test_failing_callback_does_not_stop_the_scheduler(self):
+        def fire(key):
+            if key == 'a':
+                raise Exception('boom')
+            self.fire(key)
+
+        self.scheduler.callback = fire
+        now = time.time()
+        self.scheduler.schedule('a', now + 0.05)
+        self.scheduler.schedule('b', now + 0.1)
+        self.assertEqual(['b'], self.wait_for(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import threading
+import time
+import unittest
+import uuid
+from environments import EnvironmentRegistry, STATUS_CLAIMED, STATUS_IDLE, STATUS_RUNNING
+
+
+class ConcurrentClaimTest(unittest.TestCase):
+
+    def test_concurrent_claims_never_share_an_environment(self):
+        environments = EnvironmentRegistry()
+        for i in range(0, 20):
+            environments.create(STATUS_IDLE)
+        granted = []
+        start = threading.Event()
+
+        def claim():
+            start.wait()
+            for i in range(0, 100):
+                environment = environments.claim(str(uuid.uuid4()), time.time())
+                if environment is not None:
+                    granted.append((environment, environment.claim_token))
+
+        threads = [threading.Thread(target=claim) for i in range(0, 50)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(20, len(granted))
+        self.assertEqual(20, len(set(environment.id for environment, claim_token in granted)))
+        for environment, claim_token in granted:
+            self.assertEqual(claim_token, environment.claim_token)
+        self.assertEqual(0, environments.count(STATUS_IDLE))
+
+    def test_claims_racing_releases_hold_one_token_per_environment(self):
+        environments = EnvironmentRegistry()
+        for i in range(0, 5):
+            environments.create(STATUS_IDLE)
+        errors = []
+
+        def churn():
+            for i in range(0, 500):
+                claim_token = str(uuid.uuid4())
+                environment = environments.claim(claim_token, time.time())
+                if environment is None:
+                    continue
+                if environments.find_by_claim_token(claim_token) is not environment:
+                    errors.append(claim_token)
+                if not environments.release(environment, STATUS_CLAIMED, claim_token):
+                    errors.append(claim_token)
+
+        threads = [threading.Thread(target=churn) for i in range(0, 20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(5, environments.count(STATUS_IDLE))
+
+    def test_transition_is_compare_and_set(self):
+        environments = EnvironmentRegistry()
+        environment = environments.create(STATUS_IDLE)
+        environments.claim('a', time.time())
+        self.assertFalse(environments.transition(environment, STATUS_CLAIMED, STATUS_RUNNING, 'b'))
+        self.assertTrue(environments.transition(environment, STATUS_CLAIMED, STATUS_RUNNING, 'a'))
+        self.assertFalse(environments.transition(environment, STATUS_CLAIMED, STATUS_RUNNING, 'a'))
+        self.assertEqual(STATUS_RUNNING, environment.status)
+
+
+class ClaimQueueTest(unittest.TestCase):
+
+    def test_granted_ticket_is_reported_until_it_expires(self):
+        environments = EnvironmentRegistry()
+        environment = environments.create(STATUS_IDLE)
+        environments.claim('a', 100)
+        environments.enqueue('ticket', 'b', 100)
+        environments.release(environment, STATUS_CLAIMED, 'a')
+        for now in (101, 102):
+            waiter = environments.find_ticket('ticket', now)
+            self.assertIs(environment, waiter.environment)
+            self.assertEqual('b', waiter.claim_token)
+        environments.expire_waiters(103)
+        self.assertIsNone(environments.find_ticket('ticket', 104))
+        self.assertEqual('b', environment.claim_token)
+
+    def test_hand_off_skips_abandoned_tickets(self):
+        environments = EnvironmentRegistry(ticket_timeout=30)
+        environment = environments.create(STATUS_IDLE)
+        environments.claim('a', time.time())
+        environments.enqueue('abandoned', 'b', time.time() - 60)
+        environments.enqueue('waiting', 'c', time.time())
+        environments.release(environment, STATUS_CLAIMED, 'a')
+        self.assertEqual('c', environment.claim_token)
+        self.assertIsNone(environments.find_ticket('abandoned', time.time()))
+        self.assertIs(environment, environments.find_ticket('waiting', time.time()).environment)
+
+    def test_environment_stays_idle_when_every_ticket_is_abandoned(self):
+        environments = EnvironmentRegistry(ticket_timeout=30)
+        environment = environments.create(STATUS_IDLE)
+        environments.claim('a', time.time())
+        environments.enqueue('abandoned', 'b', time.time() - 60)
+        environments.release(environment, STATUS_CLAIMED, 'a')
+        self.assertEqual(STATUS_IDLE, environment.status)
+        self.assertEqual(0, environments.queue_length())
+
+
+class IndexTest(unittest.TestCase):
+
+    def test_removed_index_is_reused(self):
+        environments = EnvironmentRegistry()
+        first = environments.create(STATUS_IDLE)
+        environments.create(STATUS_IDLE)
+        self.assertTrue(environments.remove(first, STATUS_IDLE))
+        self.assertEqual(first.id, environments.create(STATUS_IDLE).id)
+
+    def test_reserved_index_is_not_reused_until_freed(self):
+        environments = EnvironmentRegistry()
+        first = environments.create(STATUS_IDLE)
+        self.assertTrue(environments.remove(first, STATUS_IDLE, free_index=False))
+        second = environments.create(STATUS_IDLE)
+        self.assertNotEqual(first.id, second.id)
+        environments.free_index(first.index)
+        self.assertEqual(first.id, environments.create(STATUS_IDLE).id)
+
+
+if __name__ == '__main__':
+    unittest.main()
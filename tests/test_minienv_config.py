@@ -0,0 +1,75 @@
+import unittest
+from minienv_config import MinienvConfig, TabCache, get_published_ports, get_tabs
+
+
+class PublishedPortsTest(unittest.TestCase):
+
+    def test_container_port_only(self):
+        self.assertEqual([3000], get_published_ports(3000))
+        self.assertEqual([3000], get_published_ports('3000'))
+
+    def test_host_and_container_port(self):
+        self.assertEqual([8000], get_published_ports('8000:80'))
+
+    def test_protocol_is_ignored(self):
+        self.assertEqual([6060], get_published_ports('6060:6060/udp'))
+
+    def test_ranges(self):
+        self.assertEqual([3000, 3001, 3002], get_published_ports('3000-3002'))
+        self.assertEqual([9090, 9091], get_published_ports('9090-9091:8080-8081'))
+
+    def test_ip_host_and_container_port(self):
+        self.assertEqual([8001], get_published_ports('127.0.0.1:8001:8001'))
+        self.assertEqual([5000, 5001], get_published_ports('127.0.0.1:5000-5001:5000-5001'))
+
+    def test_ip_without_host_port_gives_container_port(self):
+        self.assertEqual([80], get_published_ports('127.0.0.1::80'))
+
+    def test_long_form(self):
+        self.assertEqual([8080], get_published_ports({'target': 80, 'published': 8080, 'protocol': 'tcp'}))
+        self.assertEqual([80], get_published_ports({'target': 80}))
+        self.assertEqual([], get_published_ports({'mode': 'host'}))
+
+
+class TabsTest(unittest.TestCase):
+
+    def test_one_tab_per_published_port(self):
+        compose = {'services': {'web': {'ports': ['8000:80', {'target': 3000}]}, 'db': {}}}
+        self.assertEqual([{'port': 8000, 'name': '8000', 'path': ''}, {'port': 3000, 'name': '3000', 'path': ''}],
+                         get_tabs(compose, MinienvConfig()))
+
+    def test_minienv_json_names_and_hides_tabs(self):
+        config = MinienvConfig({'proxy': {'ports': [
+            {'port': 8000, 'name': 'App', 'path': '/app'},
+            {'port': 3000, 'hide': True},
+            {'port': 4000, 'tabs': [{'name': 'Docs', 'path': '/docs'}, {'name': 'Api'}]}]}})
+        compose = {'services': {'web': {'ports': ['8000:80', '3000', '4000']}}}
+        self.assertEqual([{'port': 8000, 'name': 'App', 'path': '/app'},
+                          {'port': 4000, 'name': 'Docs', 'path': '/docs'},
+                          {'port': 4000, 'name': 'Api', 'path': ''}], get_tabs(compose, config))
+
+
+class TabCacheTest(unittest.TestCase):
+
+    def test_tabs_are_computed_once_and_copied(self):
+        cache = TabCache()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return [{'port': 80}]
+
+        tabs = cache.get('a', compute)
+        tabs[0]['url'] = 'http://localhost'
+        self.assertEqual([{'port': 80}], cache.get('a', compute))
+        self.assertEqual(1, len(calls))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = TabCache(max_entries=1)
+        cache.get('a', lambda: [])
+        cache.get('b', lambda: [])
+        self.assertEqual([{'port': 1}], cache.get('a', lambda: [{'port': 1}]))
+
+
+if __name__ == '__main__':
+    unittest.main()
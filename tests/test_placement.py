@@ -0,0 +1,80 @@
+import unittest
+from placement import Node, PlacementScheduler, parse_nodes
+
+
+class PlacementSchedulerTest(unittest.TestCase):
+
+    def test_environments_spread_across_nodes(self):
+        placement = PlacementScheduler([Node('a', 'a', 4), Node('b', 'b', 4)])
+        names = [placement.place(str(i))[0].name for i in range(0, 4)]
+        self.assertEqual(['a', 'b', 'a', 'b'], names)
+
+    def test_spreading_uses_share_of_free_slots(self):
+        placement = PlacementScheduler([Node('small', 'small', 2), Node('large', 'large', 6)])
+        names = [placement.place(str(i))[0].name for i in range(0, 8)]
+        # the small node takes its second environment once the large one is
+        # as full as it is, not after the large one fills up
+        self.assertEqual(['small', 'large', 'large', 'large', 'small', 'large', 'large', 'large'], names)
+
+    def test_ties_go_to_the_least_loaded_node(self):
+        placement = PlacementScheduler([Node('a', 'a', 4), Node('b', 'b', 4)])
+        self.assertEqual('b', placement.place('1', {'a': 3, 'b': 1})[0].name)
+
+    def test_full_cluster_returns_none(self):
+        placement = PlacementScheduler([Node('a', 'a', 1), Node('b', 'b', 1)])
+        self.assertIsNotNone(placement.place('1'))
+        self.assertIsNotNone(placement.place('2'))
+        self.assertIsNone(placement.place('3'))
+        self.assertIsNone(placement.node_for('3'))
+        self.assertEqual(2, placement.capacity())
+
+    def test_released_slot_is_reused_on_its_node(self):
+        placement = PlacementScheduler([Node('a', 'a', 3), Node('b', 'b', 3)])
+        placed = dict((str(i), placement.place(str(i))) for i in range(0, 6))
+        node, slot = placed['3']
+        placement.release('3')
+        self.assertIsNone(placement.node_for('3'))
+        self.assertNotIn('3', node.env_ids)
+        self.assertEqual((node, slot), placement.place('7'))
+        # slots are per node, so both nodes hand out the same ones
+        self.assertEqual([0, 1, 2], sorted(s for n, s in placed.values() if n.name == 'a'))
+        self.assertEqual([0, 1, 2], sorted(s for n, s in placed.values() if n.name == 'b'))
+
+    def test_release_of_unknown_environment_is_ignored(self):
+        placement = PlacementScheduler([Node('a', 'a', 1)])
+        placement.release('1')
+        self.assertEqual(1, placement.nodes['a'].free())
+
+    def test_restore_retakes_recorded_slot(self):
+        placement = PlacementScheduler([Node('a', 'a', 3)])
+        node, slot = placement.restore('1', 'a', 2)
+        self.assertEqual(('a', 2), (node.name, slot))
+        self.assertIs(node, placement.node_for('1'))
+        # new placements skip the restored slot
+        self.assertEqual([0, 1], [placement.place(str(i))[1] for i in (2, 3)])
+        self.assertIsNone(placement.place('4'))
+
+    def test_restore_rejects_invalid_placements(self):
+        placement = PlacementScheduler([Node('a', 'a', 2)])
+        placement.restore('1', 'a', 0)
+        self.assertIsNone(placement.restore('2', 'a', 0))
+        self.assertIsNone(placement.restore('2', 'gone', 1))
+        self.assertIsNone(placement.restore('2', 'a', None))
+        self.assertIsNone(placement.restore('2', 'a', 5))
+        self.assertEqual(1, placement.nodes['a'].free())
+
+
+class ParseNodesTest(unittest.TestCase):
+
+    def test_empty_spec_is_the_local_node(self):
+        nodes = parse_nodes('', 'localhost', 10)
+        self.assertEqual([('*', 'localhost', 10)], [(n.name, n.host, n.capacity) for n in nodes])
+
+    def test_host_and_capacity_default(self):
+        nodes = parse_nodes('a, b:10.0.0.2, c::5, d:10.0.0.4:7', 'localhost', 10)
+        self.assertEqual([('a', 'a', 10), ('b', '10.0.0.2', 10), ('c', 'c', 5), ('d', '10.0.0.4', 7)],
+                         [(n.name, n.host, n.capacity) for n in nodes])
+
+
+if __name__ == '__main__':
+    unittest.main()
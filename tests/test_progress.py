@@ -0,0 +1,51 @@
+import unittest
+from progress import ProgressHub
+
+
+class ProgressHubTest(unittest.TestCase):
+
+    def test_subscriber_is_woken_for_each_event(self):
+        hub = ProgressHub()
+        wakes = []
+        subscription = hub.subscribe('a', lambda: wakes.append(1))
+        hub.publish('a', 'phase', {'phase': 'creating'})
+        hub.publish('b', 'phase', {'phase': 'creating'})
+        hub.publish('a', 'up', {})
+        self.assertEqual(2, len(wakes))
+        self.assertEqual(['phase', 'up'], [name for event_id, name, data in subscription.drain()])
+
+    def test_new_subscriber_gets_latest_event(self):
+        hub = ProgressHub()
+        hub.publish('a', 'phase', {'phase': 'creating'})
+        hub.publish('a', 'up', {})
+        self.assertEqual(['up'], [name for event_id, name, data in hub.subscribe('a').drain()])
+        self.assertEqual([], hub.subscribe('b').drain())
+
+    def test_forget_drops_latest_event_and_wakes_subscribers(self):
+        hub = ProgressHub()
+        hub.publish('a', 'up', {})
+        wakes = []
+        subscription = hub.subscribe('a', lambda: wakes.append(1))
+        subscription.drain()
+        hub.forget('a')
+        self.assertEqual(2, len(wakes))
+        self.assertEqual([], hub.subscribe('a').drain())
+
+    def test_slow_subscriber_drops_oldest_events(self):
+        hub = ProgressHub(max_events=2)
+        subscription = hub.subscribe('a')
+        for phase in ('fetching', 'creating', 'ready'):
+            hub.publish('a', 'phase', {'phase': phase})
+        self.assertEqual(['creating', 'ready'], [data['phase'] for event_id, name, data in subscription.drain()])
+        self.assertEqual(1, subscription.dropped)
+
+    def test_closed_subscription_gets_no_events(self):
+        hub = ProgressHub()
+        subscription = hub.subscribe('a')
+        subscription.close()
+        hub.publish('a', 'up', {})
+        self.assertEqual([], subscription.drain())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import threading
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from repo_files import RepoFileCache
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubRepoHost(object):
+    """
+    serves <repo>/raw/master/<file> from a dict on a local port, honouring
+    If-None-Match, and records every request it gets
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.fail = False
+        self.delay = 0
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                time.sleep(stub.delay)
+                file_name = self.path.split('/raw/master/', 1)[1]
+                stub.requests.append((file_name, self.headers.getheader('If-None-Match')))
+                if stub.fail:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                if file_name not in stub.files:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                content, etag = stub.files[file_name]
+                if self.headers.getheader('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.repo = 'http://127.0.0.1:{}/minienv/example'.format(self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def requests_for(self, file_name):
+        return [request for request in self.requests if request[0] == file_name]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RepoFileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.host = StubRepoHost()
+        self.host.files['minienv.json'] = ('{"editor": {}}', '"v1"')
+
+    def tearDown(self):
+        self.host.stop()
+
+    def test_hit_is_served_from_memory(self):
+        cache = RepoFileCache(ttl=60, negative_ttl=60, max_entries=10)
+        self.assertEqual('{"editor": {}}', cache.get(self.host.repo, 'minienv.json'))
+        self.assertEqual('{"editor": {}}', cache.get(self.host.repo, 'minienv.json'))
+        self.assertEqual(1, len(self.host.requests_for('minienv.json')))
+
+    def test_expired_entry_is_revalidated_with_etag(self):
+        cache = RepoFileCache(ttl=0, negative_ttl=60, max_entries=10)
+        cache.get(self.host.repo, 'minienv.json')
+        self.assertEqual('{"editor": {}}', cache.get(self.host.repo, 'minienv.json'))
+        self.assertEqual([('minienv.json', None), ('minienv.json', '"v1"')], self.host.requests_for('minienv.json'))
+        # a changed file is picked up on the next revalidation
+        self.host.files['minienv.json'] = ('{}', '"v2"')
+        self.assertEqual('{}', cache.get(self.host.repo, 'minienv.json'))
+
+    def test_missing_file_is_cached_as_negative(self):
+        cache = RepoFileCache(ttl=60, negative_ttl=60, max_entries=10)
+        self.assertIsNone(cache.get(self.host.repo, 'docker-compose.yml'))
+        self.assertIsNone(cache.get(self.host.repo, 'docker-compose.yml'))
+        self.assertEqual(1, len(self.host.requests_for('docker-compose.yml')))
+
+    def test_negative_entry_expires(self):
+        cache = RepoFileCache(ttl=60, negative_ttl=0, max_entries=10)
+        self.assertIsNone(cache.get(self.host.repo, 'docker-compose.yml'))
+        self.host.files['docker-compose.yml'] = ('services: {}', '"c1"')
+        self.assertEqual('services: {}', cache.get(self.host.repo, 'docker-compose.yml'))
+
+    def test_stale_content_is_served_when_revalidation_fails(self):
+        cache = RepoFileCache(ttl=0, negative_ttl=60, max_entries=10)
+        cache.get(self.host.repo, 'minienv.json')
+        self.host.fail = True
+        self.assertEqual('{"editor": {}}', cache.get(self.host.repo, 'minienv.json'))
+        # the failure itself is not cached
+        self.host.fail = False
+        self.host.files['minienv.json'] = ('{}', '"v2"')
+        self.assertEqual('{}', cache.get(self.host.repo, 'minienv.json'))
+
+    def test_failure_without_cached_content_is_not_cached(self):
+        cache = RepoFileCache(ttl=60, negative_ttl=60, max_entries=10)
+        self.host.fail = True
+        self.assertIsNone(cache.get(self.host.repo, 'minienv.json'))
+        self.host.fail = False
+        self.assertEqual('{"editor": {}}', cache.get(self.host.repo, 'minienv.json'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.host.files['a'] = ('a', '"a"')
+        self.host.files['b'] = ('b', '"b"')
+        cache = RepoFileCache(ttl=60, negative_ttl=60, max_entries=2)
+        cache.get(self.host.repo, 'a')
+        cache.get(self.host.repo, 'b')
+        cache.get(self.host.repo, 'a')
+        cache.get(self.host.repo, 'minienv.json')
+        cache.get(self.host.repo, 'a')
+        cache.get(self.host.repo, 'b')
+        self.assertEqual(1, len(self.host.requests_for('a')))
+        self.assertEqual(2, len(self.host.requests_for('b')))
+
+    def test_get_many_fetches_concurrently(self):
+        self.host.delay = 0.3
+        self.host.files['docker-compose.yml'] = ('services: {}', '"c1"')
+        cache = RepoFileCache(ttl=60, negative_ttl=60, max_entries=10)
+        start_time = time.time()
+        files = cache.get_many(self.host.repo, ['minienv.json', 'docker-compose.yml', 'docker-compose.yaml'])
+        elapsed = time.time() - start_time
+        self.assertEqual({'minienv.json': '{"editor": {}}', 'docker-compose.yml': 'services: {}',
+                          'docker-compose.yaml': None}, files)
+        # three sequential fetches would take at least 0.9s
+        self.assertLess(elapsed, 0.8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+from environments import Environment, STATUS_IDLE, STATUS_RUNNING
+from state_store import StateStore
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='minienv-state-')
+        self.path = os.path.join(self.work_dir, 'minienv-state.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_saved_environments_are_loaded_after_reopening(self):
+        running = Environment('1', 0, STATUS_RUNNING)
+        running.claim_token = 'a'
+        running.last_activity = 100.5
+        running.repo = 'https://github.com/minienv/example'
+        running.details = {'logUrl': 'http://localhost:30081', 'tabs': []}
+        running.up_request = {'claimToken': 'a', 'repo': running.repo}
+        running.node = 'node-1'
+        running.slot = 3
+        running.images = ['nginx:alpine']
+        idle = Environment('2', 1, STATUS_IDLE)
+        removed = Environment('3', 2, STATUS_IDLE)
+        store = StateStore(self.path)
+        store.load()
+        store.start()
+        for environment in (running, idle, removed):
+            store.save(environment)
+        store.delete(removed.id)
+        store.close()
+
+        saved = StateStore(self.path).load()
+        self.assertEqual(['1', '2'], [values['id'] for values in saved])
+        values = saved[0]
+        self.assertEqual((0, STATUS_RUNNING, 'a', 100.5), (values['index'], values['status'],
+                                                          values['claim_token'], values['last_activity']))
+        self.assertEqual(running.details, values['details'])
+        self.assertEqual(running.up_request, values['up_request'])
+        self.assertEqual(('node-1', 3, ['nginx:alpine']), (values['node'], values['slot'], values['images']))
+        self.assertIsNone(saved[1]['repo'])
+        self.assertIsNone(saved[1]['warm_details'])
+
+    def test_latest_snapshot_wins(self):
+        environment = Environment('1', 0, STATUS_IDLE)
+        store = StateStore(self.path)
+        store.start()
+        store.save(environment)
+        environment.status = STATUS_RUNNING
+        environment.claim_token = 'b'
+        store.save(environment)
+        store.close()
+        saved = StateStore(self.path).load()
+        self.assertEqual([(STATUS_RUNNING, 'b')], [(values['status'], values['claim_token']) for values in saved])
+
+
+if __name__ == '__main__':
+    unittest.main()
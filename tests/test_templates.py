@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+import yaml
+from templates import ComposeTemplate, TemplateError
+
+TEMPLATE = """version: '3'
+services:
+  minienv:
+    image: minienv:$minienvVersion
+    ports:
+      - "$externalLogPort:$internalLogPort"
+    environment:
+      - COMPOSE_HTTP_TIMEOUT=${COMPOSE_HTTP_TIMEOUT}
+      - MINIENV_PRICE=$$5
+      - MINIENV_GIT_REPO=$gitRepo
+volumes:
+  $volumeName:
+    external: true
+"""
+
+VALUES = {
+    'minienvVersion': 'latest',
+    'externalLogPort': 30081,
+    'internalLogPort': '8001',
+    'gitRepo': 'https://github.com/minienv/example',
+    'volumeName': 'minienv-env-1-volume'
+}
+
+
+class ComposeTemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='minienv-templates-')
+        self.file_name = os.path.join(self.work_dir, 'docker-compose-env.yml.template')
+        with open(self.file_name, 'w') as f:
+            f.write(TEMPLATE)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_placeholders_are_substituted(self):
+        template = ComposeTemplate(self.file_name)
+        self.assertEqual(set(VALUES.keys()), template.variables)
+        config = template.render(VALUES)
+        service = config['services']['minienv']
+        self.assertEqual('minienv:latest', service['image'])
+        self.assertEqual(['30081:8001'], service['ports'])
+        self.assertIn('MINIENV_GIT_REPO=https://github.com/minienv/example', service['environment'])
+        # keys are templated too
+        self.assertEqual({'minienv-env-1-volume': {'external': True}}, config['volumes'])
+
+    def test_compose_variables_and_escapes_are_left_alone(self):
+        service = ComposeTemplate(self.file_name).render(VALUES)['services']['minienv']
+        self.assertIn('COMPOSE_HTTP_TIMEOUT=${COMPOSE_HTTP_TIMEOUT}', service['environment'])
+        self.assertIn('MINIENV_PRICE=$$5', service['environment'])
+
+    def test_dollar_in_a_value_is_escaped_for_compose(self):
+        values = dict(VALUES, gitRepo='https://example.com/$HOME/${USER}')
+        service = ComposeTemplate(self.file_name).render(values)['services']['minienv']
+        self.assertIn('MINIENV_GIT_REPO=https://example.com/$$HOME/$${USER}', service['environment'])
+
+    def test_unbound_variable_raises(self):
+        values = dict(VALUES)
+        del values['gitRepo']
+        del values['volumeName']
+        with self.assertRaises(TemplateError) as context:
+            ComposeTemplate(self.file_name).render(values)
+        self.assertIn('gitRepo, volumeName', str(context.exception))
+
+    def test_write_renders_to_file(self):
+        dest_file_name = os.path.join(self.work_dir, 'docker-compose-minienv-env-1.yml')
+        config = ComposeTemplate(self.file_name).write(dest_file_name, VALUES)
+        with open(dest_file_name, 'r') as f:
+            self.assertEqual(config, yaml.safe_load(f))
+        # the temporary file was renamed into place
+        self.assertEqual(['docker-compose-env.yml.template', 'docker-compose-minienv-env-1.yml'],
+                         sorted(os.listdir(self.work_dir)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+"""
+background worker pools
+"""
+
+import threading
+import uuid
+from Queue import Queue
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+class Job(object):
+    """
+    unit of work submitted to a worker pool
+    """
+
+    def __init__(self, fn, args, kwargs):
+        self.id = str(uuid.uuid4())
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        # free-form progress marker the job function may update while it runs
+        self.phase = None
+        self._started = False
+        self._done = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._done.is_set():
+            return JOB_FAILED if self.error is not None else JOB_DONE
+        return JOB_RUNNING if self._started else JOB_QUEUED
+
+    def run(self):
+        self._started = True
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._callbacks_lock:
+                self._done.set()
+                callbacks = self._callbacks
+                self._callbacks = []
+            for callback in callbacks:
+                self._call(callback)
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, callback):
+        """
+        call callback(job) once the job finished (right away if it already has)
+        """
+        with self._callbacks_lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception as e:
+            print('Job {} callback failed: {}'.format(self.id, e))
+
+    def wait(self, timeout=None):
+        """
+        block until the job finished; returns False if the timeout expired first
+        """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+
+class WorkerPool(object):
+    """
+    fixed number of daemon threads consuming a FIFO job queue
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = max(1, size)
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def submit(self, fn, *args, **kwargs):
+        return self.put(Job(fn, args, kwargs))
+
+    def put(self, job):
+        """
+        queue a job created by the caller, e.g. one already published elsewhere
+        """
+        self._start()
+        self._queue.put(job)
+        return job
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            for i in range(0, self.size):
+                thread = threading.Thread(target=self._run, name='{}-{}'.format(self.name, i + 1))
+                thread.daemon = True
+                thread.start()
+            self._started = True
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            job.run()
+            if job.error is not None:
+                print('{} job {} failed: {}'.format(self.name, job.id, job.error))
+            self._queue.task_done()